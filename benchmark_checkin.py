@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+签到工具端到端性能测试 - 在本地模拟服务器上运行PVECheckinCron和GitHubActionsCheckin
+
+每个(版本, 账号数)组合在独立的子进程中运行，以便分别统计峰值内存；模拟服务器运行在
+主进程中，负责统计每个账号实际发出的请求数。结果以JSON保存，便于比较不同版本。
+
+用法:
+  python3 benchmark_checkin.py --accounts=1,10,100,1000 --targets=pve,github --latency-ms=20
+  python3 benchmark_checkin.py --accounts=10000 --targets=pve --concurrency=50 --output=bench_10k.json
+  python3 benchmark_checkin.py --compare=bench_old.json       # 与上一次结果比较
+
+输出的每条结果包括: 吞吐量(账号/秒)、单账号签到耗时和单次请求耗时的p50/p99、
+峰值RSS、平均每个账号的请求数和各接口的请求次数。
+"""
+
+import json
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from mirror_stub_server import make_token, parse_options, start_stub_server
+
+
+DEFAULT_OPTIONS = {
+    # 测试的账号数(逗号分隔)和签到实现(pve、github)
+    "accounts": "1,10,100,1000",
+    "targets": "pve,github",
+    "concurrency": 10,
+    "transport": "requests",
+    # 模拟服务器参数，见mirror_stub_server.py
+    "latency_ms": 20.0,
+    "jitter_ms": 0.0,
+    "error_rate": 0.0,
+    "signed_rate": 0.0,
+    # 初始token已过期(需要重新登录)的账号比例
+    "expired_rate": 0.1,
+    "seed": 1,
+    "output": "bench_results.json",
+    "compare": "",
+    # 以下参数由主进程传给子进程
+    "worker": "",
+    "count": 0,
+    "base_url": "",
+    "result_file": ""
+}
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def percentile(values, pct):
+    """最近秩法百分位数，values为空时返回None"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return round(ordered[rank - 1], 2)
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:  # Windows没有resource模块
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux单位为KB，macOS为字节
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def bench_accounts(options):
+    """生成测试账号，按expired_rate给部分账号分配已过期的token"""
+    rng = random.Random(options['seed'])
+    accounts = []
+    for i in range(options['count']):
+        email = f"bench{i}@example.com"
+        ttl = -3600 if rng.random() < options['expired_rate'] else 86400
+        accounts.append({
+            "name": f"bench{i}",
+            "login": {"email": email, "password": "bench"},
+            "auth_token": make_token(email, ttl)
+        })
+    return accounts
+
+
+def bench_config(options, accounts):
+    return {
+        "base_url": options['base_url'],
+        "accounts": accounts,
+        "batch": {"concurrency": options['concurrency']},
+        "http": {"transport": options['transport'], "pool_size": options['concurrency']},
+        "email_alerts": {"enabled": False},
+        "retry": {"base_delay": 0.5, "budget": 120}
+    }
+
+
+def time_requests(session, latencies):
+    """在共享的HTTP会话上记录每次请求的客户端耗时(get/post都经过request)"""
+    request = session.request
+
+    def timed_request(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return request(*args, **kwargs)
+        finally:
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    session.request = timed_request
+
+
+def run_pve(options, accounts):
+    """批量模式运行PVECheckinCron，单账号耗时取自account span"""
+    from pve_checkin_cron import PVECheckinCron
+
+    config_path = os.path.join(os.getcwd(), "pve_checkin_config.json")
+    with open(config_path, 'w', encoding='utf-8') as f:
+        json.dump(bench_config(options, accounts), f)
+
+    started = time.perf_counter()
+    checkin = PVECheckinCron(config_path)
+    request_latencies = []
+    time_requests(checkin.session, request_latencies)
+    checkin.run_batch()
+    checkin.flush_notifications()
+    wall = time.perf_counter() - started
+
+    spans = [span for span in checkin.tracer.drain() if span['name'] == 'account']
+    return {
+        "wall_seconds": wall,
+        "account_latencies": [span['duration_ms'] for span in spans],
+        "request_latencies": request_latencies,
+        "succeeded": sum(1 for span in spans if span.get('success')),
+        "failed": sum(1 for span in spans if not span.get('success'))
+    }
+
+
+def run_github(options, accounts):
+    """GitHub Actions版本每个实例对应一个账号，在线程池中按concurrency并发运行"""
+    from concurrent.futures import ThreadPoolExecutor
+    import github_actions_checkin
+
+    config = bench_config(options, accounts)
+    del config['accounts']
+    with open("pve_checkin_config.json", 'w', encoding='utf-8') as f:
+        json.dump(config, f)
+
+    started = time.perf_counter()
+    # 实例在主线程中依次创建(setup_logging会重置全局日志处理器)
+    instances = []
+    for account in accounts:
+        checkin = github_actions_checkin.GitHubActionsCheckin()
+        checkin.config = dict(checkin.config, login=account['login'], auth_token=account['auth_token'])
+        instances.append(checkin)
+
+    request_latencies = []
+    time_requests(github_actions_checkin.get_http_session(), request_latencies)
+
+    def run_one(checkin):
+        account_started = time.perf_counter()
+        try:
+            success = checkin.run_checkin()
+        except Exception:
+            success = False
+        return success, (time.perf_counter() - account_started) * 1000
+
+    with ThreadPoolExecutor(max_workers=options['concurrency']) as executor:
+        results = list(executor.map(run_one, instances))
+    for checkin in instances:
+        checkin.flush_notifications()
+    wall = time.perf_counter() - started
+
+    return {
+        "wall_seconds": wall,
+        "account_latencies": [elapsed for _, elapsed in results],
+        "request_latencies": request_latencies,
+        "succeeded": sum(1 for success, _ in results if success),
+        "failed": sum(1 for success, _ in results if not success)
+    }
+
+
+def run_worker(options):
+    """子进程: 在当前目录(临时目录)中运行一个测试组合，结果写入result_file"""
+    sys.path.insert(0, SCRIPT_DIR)
+    accounts = bench_accounts(options)
+    runner = run_pve if options['worker'] == 'pve' else run_github
+    result = runner(options, accounts)
+
+    count = options['count']
+    wall = result['wall_seconds']
+    summary = {
+        "target": options['worker'],
+        "accounts": count,
+        "concurrency": options['concurrency'],
+        "transport": options['transport'],
+        "wall_seconds": round(wall, 3),
+        "throughput_per_sec": round(count / wall, 2) if wall else None,
+        "account_latency_ms": {
+            "p50": percentile(result['account_latencies'], 50),
+            "p99": percentile(result['account_latencies'], 99)
+        },
+        "request_latency_ms": {
+            "p50": percentile(result['request_latencies'], 50),
+            "p99": percentile(result['request_latencies'], 99)
+        },
+        "peak_rss_mb": peak_rss_mb(),
+        "succeeded": result['succeeded'],
+        "failed": result['failed']
+    }
+    with open(options['result_file'], 'w', encoding='utf-8') as f:
+        json.dump(summary, f)
+
+
+def run_case(options, target, count, base_url, stub_state):
+    """在临时目录中启动子进程运行一个组合，附加模拟服务器统计的请求数"""
+    workdir = tempfile.mkdtemp(prefix="checkin-bench-")
+    result_file = os.path.join(workdir, "result.json")
+    worker_options = {
+        "worker": target,
+        "count": count,
+        "base_url": base_url,
+        "result_file": result_file,
+        "concurrency": options['concurrency'],
+        "transport": options['transport'],
+        "expired_rate": options['expired_rate'],
+        "seed": options['seed']
+    }
+    command = [sys.executable, os.path.abspath(__file__)]
+    command += [f"--{name.replace('_', '-')}={value}" for name, value in worker_options.items()]
+
+    stub_state.reset()
+    try:
+        process = subprocess.run(command, cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        if process.returncode != 0 or not os.path.exists(result_file):
+            raise RuntimeError(f"{target} {count} 个账号测试失败:\n{process.stderr[-2000:]}")
+        with open(result_file, 'r', encoding='utf-8') as f:
+            summary = json.load(f)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    stats = stub_state.stats()
+    summary["requests_per_account"] = round(stats['total'] / count, 2)
+    summary["requests_by_endpoint"] = stats['requests']
+    return summary
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=SCRIPT_DIR,
+            capture_output=True, text=True, timeout=5
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def format_result(result):
+    account, request = result['account_latency_ms'], result['request_latency_ms']
+    return (
+        f"{result['target']:<7} {result['accounts']:>6} 个账号  {result['throughput_per_sec']:>9} 账号/秒  "
+        f"账号 p50 {account['p50']}ms p99 {account['p99']}ms  请求 p50 {request['p50']}ms p99 {request['p99']}ms  "
+        f"RSS {result['peak_rss_mb']}MB  {result['requests_per_account']} 请求/账号  失败 {result['failed']}"
+    )
+
+
+def compare_results(previous_path, results):
+    """按(版本, 账号数)对比吞吐量和p99耗时的变化"""
+    with open(previous_path, 'r', encoding='utf-8') as f:
+        previous = json.load(f)
+    baseline = {(item['target'], item['accounts']): item for item in previous.get('results', [])}
+
+    print(f"\n与 {previous_path} ({previous.get('revision')}) 比较:")
+    for result in results:
+        old = baseline.get((result['target'], result['accounts']))
+        if old is None:
+            continue
+        changes = []
+        for label, new_value, old_value in (
+            ("吞吐量", result['throughput_per_sec'], old['throughput_per_sec']),
+            ("账号p99", result['account_latency_ms']['p99'], old['account_latency_ms']['p99']),
+            ("请求/账号", result['requests_per_account'], old['requests_per_account'])
+        ):
+            if new_value is None or not old_value:
+                continue
+            changes.append(f"{label} {old_value} -> {new_value} ({(new_value - old_value) / old_value * 100:+.1f}%)")
+        print(f"  {result['target']:<7} {result['accounts']:>6} 个账号: {', '.join(changes)}")
+
+
+def main():
+    try:
+        options = parse_options(sys.argv[1:], DEFAULT_OPTIONS)
+    except ValueError as e:
+        print(e)
+        sys.exit(2)
+
+    if options['worker']:
+        run_worker(options)
+        return
+
+    counts = [int(count) for count in options['accounts'].split(',') if count.strip()]
+    targets = [target.strip() for target in options['targets'].split(',') if target.strip()]
+    unknown = set(targets) - {'pve', 'github'}
+    if unknown:
+        print(f"未知的targets: {', '.join(sorted(unknown))} (可选 pve、github)")
+        sys.exit(2)
+
+    server, stub_state = start_stub_server(
+        port=0,
+        latency_ms=options['latency_ms'],
+        jitter_ms=options['jitter_ms'],
+        error_rate=options['error_rate'],
+        signed_rate=options['signed_rate'],
+        seed=options['seed']
+    )
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    print(f"Stub server: {base_url} (latency {options['latency_ms']}ms, error rate {options['error_rate']})")
+
+    results = []
+    try:
+        for target in targets:
+            for count in counts:
+                result = run_case(options, target, count, base_url, stub_state)
+                print(format_result(result))
+                results.append(result)
+    except RuntimeError as e:
+        print(e)
+        sys.exit(1)
+    finally:
+        server.shutdown()
+
+    report = {
+        "revision": git_revision(),
+        "timestamp": datetime.now().isoformat(timespec='seconds'),
+        "python": sys.version.split()[0],
+        "options": {key: value for key, value in options.items() if key not in ('worker', 'count', 'base_url', 'result_file')},
+        "results": results
+    }
+    with open(options['output'], 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"结果已保存: {options['output']}")
+
+    if options['compare']:
+        compare_results(options['compare'], results)
+
+if __name__ == "__main__":
+    main()
@@ -5,28 +5,127 @@ GitHub Actions版本的自动签到工具 - mirror.o3pro.pro
 专为GitHub Actions环境优化，去除了文件权限和路径依赖
 """
 
-import requests
 import json
+import base64
+import hashlib
+import time
 import logging
-import smtplib
 import os
 import sys
 from datetime import datetime
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from email.header import Header
+
+# requests、smtplib和email.mime只在真正用到时导入，缩短冷启动时间
+
+# 与PVE版本共用的辅助函数和类(HTTP会话、积分计算、通知队列、重试策略、截止时间)，
+# 工作流检出整个仓库，两个脚本在同一目录
+from pve_checkin_cron import (
+    BalanceTracker,
+    Deadline,
+    DeadlineExceeded,
+    NotificationDispatcher,
+    Prefetch,
+    RetryPolicy,
+    decode_token_expiry,
+    format_balance_info,
+    get_http_session,
+    profile_startup
+)
+
+
+class TokenCache:
+    """加密的token缓存文件 - 由工作流在两次运行之间恢复和保存(actions/cache)
+
+    文件内容为 {"version", "salt", "data"}，data是用TOKEN_CACHE_KEY派生的密钥经Fernet
+    加密的 {"email_hash", "token", "expires_at", "updated_at"}。版本不符、密钥错误或
+    登录邮箱已更换时缓存作废，不会影响签到。
+    """
+
+    VERSION = 1
+
+    def __init__(self, path, passphrase):
+        self.path = path
+        self.passphrase = passphrase
+
+    @staticmethod
+    def email_hash(email):
+        return hashlib.sha256(email.strip().lower().encode('utf-8')).hexdigest()
+
+    def _fernet(self, salt):
+        from cryptography.fernet import Fernet
+        
+        key = hashlib.pbkdf2_hmac('sha256', self.passphrase.encode('utf-8'), salt, 200000)
+        return Fernet(base64.urlsafe_b64encode(key))
+
+    def load(self, email):
+        """读取缓存的token，文件不存在时返回None，无法使用时抛出ValueError说明原因"""
+        from cryptography.fernet import InvalidToken
+        
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, 'r', encoding='utf-8') as f:
+            envelope = json.load(f)
+        if envelope.get('version') != self.VERSION:
+            raise ValueError(f"缓存版本 {envelope.get('version')} 与当前版本 {self.VERSION} 不符")
+            
+        try:
+            salt = base64.b64decode(envelope['salt'])
+            entry = json.loads(self._fernet(salt).decrypt(envelope['data'].encode('ascii')))
+        except (InvalidToken, KeyError, ValueError):
+            raise ValueError("无法解密，TOKEN_CACHE_KEY可能已更换")
+        if entry.get('email_hash') != self.email_hash(email):
+            raise ValueError("登录邮箱已更换")
+        return entry.get('token')
+
+    def save(self, email, token):
+        """加密写入token缓存(临时文件 + rename)"""
+        salt = os.urandom(16)
+        entry = {
+            "email_hash": self.email_hash(email),
+            "token": token,
+            "expires_at": decode_token_expiry(token),
+            "updated_at": int(time.time())
+        }
+        envelope = {
+            "version": self.VERSION,
+            "salt": base64.b64encode(salt).decode('ascii'),
+            "data": self._fernet(salt).encrypt(json.dumps(entry).encode('utf-8')).decode('ascii')
+        }
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(envelope, f)
+        os.replace(tmp_path, self.path)
+
 
 class GitHubActionsCheckin:
     def __init__(self):
         self.config_file = "pve_checkin_config.json"
-        self.base_url = "https://mirror.o3pro.pro"
         
         # 加载配置
         self.load_config()
+        self.base_url = self.config.get('base_url', "https://mirror.o3pro.pro").rstrip('/')
         
         # 设置日志 - GitHub Actions优化
         self.setup_logging()
         
+        # 上次运行刷新的token - 比Secrets中的token更新时直接使用，跳过登录
+        self.token_cache = self.open_token_cache()
+        self.restore_cached_token()
+        
+        # 共享的HTTP连接池
+        self.session = get_http_session(self.config.get('http'))
+        
+        # 邮件通知队列
+        self.notifier = NotificationDispatcher()
+        
+        # 最近一次请求失败的HTTP状态码或异常，用于判断是否可重试
+        self.last_failure = None
+        
+        # 后台查询中的签到前余额 (BalanceTracker, Prefetch)，签到请求发出前取回
+        self.pending_baseline = None
+        
+        # 整次运行的截止时间(timeouts.run)，由run_checkin设置
+        self.deadline = Deadline()
+        
         # 设置基础请求头
         self.base_headers = {
             'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
@@ -51,6 +150,62 @@ class GitHubActionsCheckin:
             print(f"配置文件 {self.config_file} 不存在")
             sys.exit(1)
             
+    def open_token_cache(self):
+        """按环境变量TOKEN_CACHE_KEY打开加密的token缓存，未配置密钥或缺少cryptography时不使用缓存"""
+        passphrase = os.environ.get('TOKEN_CACHE_KEY', '')
+        if not passphrase:
+            return None
+        import importlib.util
+        if importlib.util.find_spec("cryptography") is None:
+            self.logger.warning("未安装cryptography，跳过token缓存")
+            return None
+        path = self.config.get('token_cache', {}).get('file', 'token_cache.json')
+        return TokenCache(path, passphrase)
+        
+    def restore_cached_token(self):
+        """缓存中的token比配置中的更晚过期时改用缓存的token
+
+        非JWT格式的token无法比较过期时间，保留为备用，配置中的token验证失败后再使用。
+        """
+        self._restored_token = self.config.get('auth_token')
+        self._fallback_token = None
+        if self.token_cache is None:
+            return
+        try:
+            cached = self.token_cache.load(self.config['login']['email'])
+        except (OSError, ValueError) as e:
+            self.logger.warning(f"token缓存不可用: {e}")
+            return
+        if not cached or cached == self.config.get('auth_token'):
+            return
+            
+        cached_expiry = decode_token_expiry(cached)
+        if cached_expiry is None:
+            self._fallback_token = cached
+            self.logger.info("缓存的token不是JWT格式，配置中的token验证失败时再使用")
+            return
+        if cached_expiry <= time.time():
+            self.logger.info("缓存的token已过期，忽略")
+            return
+        current_expiry = decode_token_expiry(self.config.get('auth_token') or '')
+        if current_expiry is not None and current_expiry >= cached_expiry:
+            return
+            
+        self.config['auth_token'] = self._restored_token = cached
+        self.logger.info(f"使用缓存的token，剩余 {(cached_expiry - time.time()) / 3600:.1f} 小时")
+        
+    def save_token_cache(self):
+        """本次运行刷新了token时写入缓存，供下次运行使用"""
+        token = self.config.get('auth_token')
+        if self.token_cache is None or not token or token == self._restored_token:
+            return
+        try:
+            self.token_cache.save(self.config['login']['email'], token)
+            self._restored_token = token
+            self.logger.info(f"已保存刷新后的token到缓存: {self.token_cache.path}")
+        except Exception as e:
+            self.logger.error(f"保存token缓存失败: {e}")
+            
     def setup_logging(self):
         """配置日志系统 - GitHub Actions优化"""
         log_format = '%(asctime)s - %(levelname)s - %(message)s'
@@ -74,6 +229,13 @@ class GitHubActionsCheckin:
         headers['Authorization'] = f'Bearer {self.config["auth_token"]}'
         return headers
         
+    def call_timeout(self, name, what):
+        """单次请求的超时 - timeouts中的配置值，不超过运行剩余时间；剩余时间不足时抛出DeadlineExceeded"""
+        if self.deadline.expired:
+            raise DeadlineExceeded(f"已超过截止时间，跳过{what}")
+        defaults = {"login": 30, "request": 10}
+        return self.deadline.cap(self.config.get('timeouts', {}).get(name, defaults[name]))
+        
     def login_and_get_token(self):
         """登录获取新的token"""
         try:
@@ -85,11 +247,11 @@ class GitHubActionsCheckin:
                 "password": self.config["login"]["password"]
             }
             
-            response = requests.post(
+            response = self.session.post(
                 login_url, 
                 headers=self.base_headers, 
                 json=login_data, 
-                timeout=30
+                timeout=self.call_timeout('login', "登录")
             )
             
             if response.status_code == 200:
@@ -111,10 +273,12 @@ class GitHubActionsCheckin:
                     self.logger.error(f"登录响应中未找到token: {result}")
                     return False
             else:
+                self.last_failure = response.status_code
                 self.logger.error(f"登录失败: {response.status_code} - {response.text}")
                 return False
                 
         except Exception as e:
+            self.last_failure = e
             self.logger.error(f"登录过程出错: {e}")
             return False
             
@@ -122,7 +286,7 @@ class GitHubActionsCheckin:
         """检查Token有效性"""
         try:
             url = f"{self.base_url}/api/auth/user"
-            response = requests.get(url, headers=self.get_auth_headers(), timeout=10)
+            response = self.session.get(url, headers=self.get_auth_headers(), timeout=self.call_timeout('request', "token验证"))
             
             if response.status_code == 200:
                 user_data = response.json()
@@ -133,27 +297,74 @@ class GitHubActionsCheckin:
                 self.logger.warning("Token已失效")
                 return False
             else:
+                self.last_failure = response.status_code
                 self.logger.error(f"Token验证失败: {response.status_code}")
                 return False
                 
         except Exception as e:
+            self.last_failure = e
             self.logger.error(f"Token验证出错: {e}")
             return False
             
     def ensure_valid_token(self):
         """确保token有效，失效时自动重新登录"""
+        token_config = self.config.get('token', {})
+        expires_at = decode_token_expiry(self.config.get('auth_token') or '')
+        
+        # JWT可在本地判断过期时间，剩余时间充足时跳过/api/auth/user请求
+        if token_config.get('local_check', True) and expires_at is not None:
+            remaining = expires_at - time.time()
+            if remaining > token_config.get('refresh_margin', 3600):
+                self.logger.info(f"Token本地校验有效，剩余 {remaining / 3600:.1f} 小时")
+                return True
+                
+            self.logger.info("Token即将过期，提前重新登录" if remaining > 0 else "Token已过期，重新登录")
+            if self.login_and_get_token():
+                return True
+            # 提前刷新失败时，尚未过期的token仍交给服务器验证
+            return remaining > 0 and self.check_token_validity()
+            
+        # 非JWT格式的token只能由服务器验证
         if self.check_token_validity():
             return True
+        if self.use_fallback_token():
+            return True
         return self.login_and_get_token()
         
+    def use_fallback_token(self):
+        """配置中的token失效时改用缓存中的非JWT token，验证通过返回True"""
+        fallback, self._fallback_token = self._fallback_token, None
+        if not fallback or fallback == self.config.get('auth_token'):
+            return False
+        current = self.config.get('auth_token')
+        self.config['auth_token'] = fallback
+        if self.check_token_validity():
+            self._restored_token = fallback
+            self.logger.info("配置中的token已失效，使用缓存的token")
+            return True
+        self.config['auth_token'] = current
+        return False
+        
     def perform_checkin(self):
         """执行签到"""
+        self.last_failure = None
         try:
             if not self.ensure_valid_token():
                 return False, {"error": "无法获取有效的认证token"}
                 
+            # 签到会改变余额，签到前余额必须在签到请求之前取回
+            if not self.resolve_baseline():
+                return False, {"error": "Token已失效且重新登录失败"}
+                
             url = f"{self.base_url}/api/checkin"
-            response = requests.post(url, headers=self.get_auth_headers(), json={}, timeout=10)
+            response = self.session.post(url, headers=self.get_auth_headers(), json={}, timeout=self.call_timeout('request', "签到"))
+            
+            # 本地校验通过但服务器已吊销token时，重新登录后重试一次
+            if response.status_code == 401:
+                self.logger.warning("签到接口返回401，重新登录后重试")
+                if not self.login_and_get_token():
+                    return False, {"error": "Token已失效且重新登录失败"}
+                response = self.session.post(url, headers=self.get_auth_headers(), json={}, timeout=self.call_timeout('request', "签到"))
             
             if response.status_code == 200:
                 try:
@@ -173,6 +384,7 @@ class GitHubActionsCheckin:
                     self.logger.info("签到成功! (无JSON响应)")
                     return True, {"message": "签到成功"}
             else:
+                self.last_failure = response.status_code
                 try:
                     error_result = response.json()
                     self.logger.error(f"签到失败: {response.status_code} - {response.text}")
@@ -182,6 +394,7 @@ class GitHubActionsCheckin:
                     return False, {"error": f"HTTP {response.status_code}", "raw_response": response.text}
                 
         except Exception as e:
+            self.last_failure = e
             self.logger.error(f"签到请求出错: {e}")
             return False, {"error": str(e)}
             
@@ -189,19 +402,67 @@ class GitHubActionsCheckin:
         """查询积分余额"""
         try:
             url = f"{self.base_url}/api/credits/balance"
-            response = requests.get(url, headers=self.get_auth_headers(), timeout=10)
+            response = self.session.get(url, headers=self.get_auth_headers(), timeout=self.call_timeout('request', "积分查询"))
             
             if response.status_code == 200:
                 return response.json()
             else:
                 return None
                 
+        except DeadlineExceeded as e:
+            self.logger.warning(f"积分查询: {e}")
+            return None
         except Exception as e:
             self.logger.error(f"积分查询出错: {e}")
             return None
             
+    def fetch_balance_data(self):
+        """查询积分余额，返回响应中的balance字段"""
+        balance = self.get_credits_balance()
+        if balance and isinstance(balance.get('balance'), dict):
+            return balance['balance']
+        return None
+        
+    def prefetch_baseline(self):
+        """查询签到前余额，返回(balance字段, HTTP状态码, 使用的token) - 在后台线程中与token验证并行执行"""
+        token = self.config.get('auth_token')
+        try:
+            url = f"{self.base_url}/api/credits/balance"
+            response = self.session.get(url, headers=self.get_auth_headers(), timeout=self.call_timeout('request', "积分查询"))
+        except Exception as e:
+            self.logger.warning(f"签到前积分查询出错: {e}")
+            return None, None, token
+            
+        balance = None
+        if response.status_code == 200:
+            try:
+                balance = response.json().get('balance')
+            except (ValueError, AttributeError):
+                pass
+        return (balance if isinstance(balance, dict) else None), response.status_code, token
+        
+    def resolve_baseline(self):
+        """取回后台查询的签到前余额 - 余额接口返回401时，若token未被刷新过则重新登录，然后再查一次
+
+        重新登录失败时返回False。
+        """
+        if self.pending_baseline is None:
+            return True
+        tracker, prefetch = self.pending_baseline
+        self.pending_baseline = None
+        
+        balance, status, token = prefetch.result()
+        if status == 401:
+            if token == self.config.get('auth_token'):
+                self.logger.warning("积分接口返回401，重新登录")
+                if not self.login_and_get_token():
+                    return False
+            balance = self.fetch_balance_data()
+        tracker.baseline = balance
+        return True
+            
     def _send_email_alert(self, subject, body, alert_type="info"):
-        """发送邮件预警 - GitHub Actions版本"""
+        """发送邮件预警 - GitHub Actions版本，邮件放入通知队列由后台线程发送"""
         email_config = self.config.get('email_alerts', {})
         
         if not email_config.get('enabled', False):
@@ -216,8 +477,17 @@ class GitHubActionsCheckin:
             self.logger.warning(f"邮件配置不完整，缺少字段: {missing_fields}，跳过邮件发送")
             return
             
+        # 超过运行截止时间后只发送失败通知，其他邮件不再入队
+        if self.deadline.expired and alert_type != "error":
+            self.logger.warning(f"已超过运行截止时间，跳过邮件: {subject}")
+            return
+            
         try:
-            self.logger.info(f"准备发送邮件: {subject}, 类型: {alert_type}")
+            self.logger.info(f"邮件加入发送队列: {subject}, 类型: {alert_type}")
+            
+            from email.mime.text import MIMEText
+            from email.mime.multipart import MIMEMultipart
+            from email.header import Header
             
             # 创建邮件
             msg = MIMEMultipart()
@@ -242,15 +512,24 @@ Run ID: {os.environ.get('GITHUB_RUN_ID', 'Unknown')}
 """
             
             msg.attach(MIMEText(full_body, 'plain', 'utf-8'))
+            self.notifier.submit(self._deliver_email, email_config, msg, subject)
+            
+        except Exception as e:
+            self.logger.error(f"创建邮件失败: {e}")
             
-            # 发送邮件
+    def _deliver_email(self, email_config, msg, subject):
+        """连接SMTP服务器发送邮件 - 在通知队列的后台线程中执行"""
+        import smtplib
+        timeout = self.deadline.cap(email_config.get('smtp_timeout', 20), email_config.get('flush_grace', 10))
+        
+        try:
             smtp_port = email_config['smtp_port']
             self.logger.info(f"连接SMTP服务器: {email_config['smtp_server']}:{smtp_port}")
             
             if smtp_port == 465:
-                server = smtplib.SMTP_SSL(email_config['smtp_server'], smtp_port)
+                server = smtplib.SMTP_SSL(email_config['smtp_server'], smtp_port, timeout=timeout)
             else:
-                server = smtplib.SMTP(email_config['smtp_server'], smtp_port)
+                server = smtplib.SMTP(email_config['smtp_server'], smtp_port, timeout=timeout)
                 server.starttls()
             
             server.login(email_config['smtp_user'], email_config['smtp_password'])
@@ -259,9 +538,24 @@ Run ID: {os.environ.get('GITHUB_RUN_ID', 'Unknown')}
             server.quit()
             
             self.logger.info(f"邮件发送成功: {subject}")
+            return True
             
         except Exception as e:
             self.logger.error(f"发送邮件失败: {e}")
+            return False
+            
+    def flush_notifications(self):
+        """退出前等待通知队列发送完毕，最多等待flush_timeout秒(不超过运行剩余时间，但至少flush_grace秒)"""
+        if not self.notifier.pending:
+            return True
+            
+        email_config = self.config.get('email_alerts', {})
+        timeout = self.deadline.cap(email_config.get('flush_timeout', 60), email_config.get('flush_grace', 10))
+        self.logger.info(f"等待 {self.notifier.pending} 封邮件发送完成 (最多 {timeout} 秒)")
+        if not self.notifier.flush(timeout):
+            self.logger.error(f"邮件发送超时，放弃 {self.notifier.pending} 封未发送的邮件")
+            return False
+        return True
             
     def run_checkin(self):
         """运行签到任务 - GitHub Actions版本"""
@@ -269,33 +563,52 @@ Run ID: {os.environ.get('GITHUB_RUN_ID', 'Unknown')}
         self.logger.info("开始GitHub Actions自动签到任务")
         self.logger.info("=" * 60)
         
-        # 获取签到前积分
-        before_balance = self.get_credits_balance()
-        before_credits = 0
-        if before_balance:
-            before_credits = before_balance.get('balance', {}).get('available', 0)
+        self.deadline = Deadline(self.config.get('timeouts', {}).get('run', 0))
+        
+        # 获取签到前积分 - Actions运行之间没有状态文件，需要查询基准余额；
+        # 查询与token验证互不依赖，在后台进行，签到请求发出前取回
+        tracker = BalanceTracker()
+        self.pending_baseline = (tracker, Prefetch(self.prefetch_baseline))
             
-        # 执行签到
+        # 执行签到 - 可重试的失败按退避策略重试
+        retry_config = self.config.get('retry', {})
+        retry_policy = RetryPolicy(
+            max_retries=self.config.get('max_retries', 3),
+            base_delay=retry_config.get('base_delay', 10),
+            max_delay=self.config.get('retry_delay', 300),
+            budget=retry_config.get('budget', 900)
+        )
         success, result = self.perform_checkin()
+        attempt = 0
+        while not success and retry_policy.is_retryable(self.last_failure):
+            delay = retry_policy.next_delay(attempt)
+            if delay is None:
+                self.logger.error(f"签到失败 {attempt + 1} 次，重试次数或时间预算已用完")
+                break
+            remaining = self.deadline.remaining()
+            if remaining is not None and delay >= remaining:
+                self.logger.error(f"签到失败 {attempt + 1} 次，截止时间前无法完成重试")
+                break
+            attempt += 1
+            self.logger.warning(f"签到失败(可重试: {self.last_failure})，{delay:.1f} 秒后第 {attempt} 次重试")
+            time.sleep(delay)
+            success, result = self.perform_checkin()
         
         if success:
             # 获取签到后积分
-            after_balance = self.get_credits_balance()
-            after_credits = before_credits
-            earned = 0
-            
-            if after_balance:
-                after_credits = after_balance.get('balance', {}).get('available', 0)
-                earned = after_credits - before_credits
+            tracker.after = self.fetch_balance_data()
+            earned = tracker.earned(result)
+            before_credits, after_credits = tracker.credits_change(earned)
                 
-            if earned > 0:
-                balance_info = ""
-                if after_balance and 'balance' in after_balance:
-                    balance_data = after_balance['balance']
-                    available = balance_data.get('available', 0)
-                    used = balance_data.get('used', 0)
-                    total = available + used
-                    balance_info = f"\n积分信息:\n  总积分: {total}\n  可用积分: {available}\n  已使用: {used}"
+            if earned is None:
+                # 签到前余额未知(如token失效导致查询失败)，只报告当前积分
+                success_msg = f"签到成功! 当前可用积分: {after_credits}{format_balance_info(tracker.after)}"
+                self.logger.info(success_msg)
+                
+                if self.config['email_alerts'].get('on_success', False):
+                    self._send_email_alert("签到成功", success_msg, "success")
+            elif earned > 0:
+                balance_info = format_balance_info(tracker.after)
                 
                 success_msg = f"签到成功! 获得 {earned} 积分，总积分: {before_credits} -> {after_credits}{balance_info}"
                 self.logger.info(success_msg)
@@ -322,6 +635,9 @@ def main():
     """主函数 - GitHub Actions版本"""
     test_mode = '--test' in sys.argv
     
+    if '--profile-startup' in sys.argv:
+        sys.exit(profile_startup("pve_checkin_config.json", module="github_actions_checkin"))
+        
     try:
         checkin = GitHubActionsCheckin()
         
@@ -335,6 +651,12 @@ def main():
         if test_mode:
             print(f"Result: {'Success' if success else 'Failed'}")
             
+        # 签到失败时刷新的token同样有效，也保存到缓存
+        checkin.save_token_cache()
+            
+        # 退出前发送完队列中的邮件
+        checkin.flush_notifications()
+            
         sys.exit(0 if success else 1)
         
     except Exception as e:
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+mirror.o3pro.pro 本地模拟服务器 - 用于性能测试和回归测试，不访问真实服务
+
+实现签到工具用到的四个接口:
+  POST /api/auth/login      任意邮箱和非空密码都能登录，返回带exp的JWT格式token
+  GET  /api/auth/user       token有效时返回用户信息，过期或无效时返回401
+  POST /api/checkin         每个邮箱每天第一次签到获得积分，之后返回"今日已签到"
+  GET  /api/credits/balance 返回积分余额
+
+可配置每个请求的延迟、随机503错误率、token有效期和"今日已签到"账号的比例。
+GET /__stats 返回各接口的请求次数，POST /__reset 清空计数和签到状态。
+
+用法:
+  python3 mirror_stub_server.py --port=18080 --latency-ms=50 --error-rate=0.01
+然后把配置文件中的 base_url 设为 http://127.0.0.1:18080
+"""
+
+import json
+import base64
+import time
+import random
+import threading
+import zlib
+import sys
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+DEFAULT_OPTIONS = {
+    "host": "127.0.0.1",
+    "port": 18080,
+    # 每个请求的固定延迟和随机抖动(毫秒)
+    "latency_ms": 0.0,
+    "jitter_ms": 0.0,
+    # 返回503的请求比例(登录和业务接口都会受影响)
+    "error_rate": 0.0,
+    # 登录签发的token有效期(秒)，过期后接口返回401
+    "token_ttl": 86400,
+    # 按邮箱哈希选出的"今日已签到"账号比例
+    "signed_rate": 0.0,
+    # 签到获得的积分和初始余额
+    "reward": 500,
+    "initial_balance": 1000,
+    "seed": None
+}
+
+
+def make_token(email, ttl):
+    """签发JWT格式的token(签名部分不校验)，ttl为负数时得到已过期的token"""
+    def encode(data):
+        return base64.urlsafe_b64encode(json.dumps(data).encode('utf-8')).rstrip(b'=').decode('ascii')
+    return f"{encode({'alg': 'HS256', 'typ': 'JWT'})}.{encode({'email': email, 'exp': int(time.time() + ttl)})}.stub"
+
+
+def parse_options(argv, defaults):
+    """解析--name=value形式的参数，名称中的-对应选项中的_，值按默认值的类型转换"""
+    options = dict(defaults)
+    for arg in argv:
+        if not arg.startswith('--') or '=' not in arg:
+            raise ValueError(f"无法识别的参数: {arg} (格式为 --name=value)")
+        name, value = arg[2:].split('=', 1)
+        name = name.replace('-', '_')
+        if name not in options:
+            raise ValueError(f"未知参数: --{name.replace('_', '-')}")
+        default = options[name]
+        if isinstance(default, bool):
+            options[name] = value.lower() in ('1', 'true', 'yes')
+        elif isinstance(default, int):
+            options[name] = int(float(value))
+        elif isinstance(default, float):
+            options[name] = float(value)
+        else:
+            options[name] = value
+    return options
+
+
+class StubState:
+    """模拟服务器的账号状态和请求计数，多个处理线程共享"""
+
+    def __init__(self, options):
+        self.options = options
+        self.random = random.Random(options.get('seed'))
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counts = {}
+            self.signed = set()
+            self.balances = {}
+
+    def count(self, method, path):
+        key = f"{method} {path}"
+        with self._lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self.counts)
+        return {"requests": counts, "total": sum(counts.values())}
+
+    def should_fail(self):
+        rate = self.options['error_rate']
+        if rate <= 0:
+            return False
+        with self._lock:
+            return self.random.random() < rate
+
+    def delay(self):
+        latency = self.options['latency_ms'] / 1000
+        jitter = self.options['jitter_ms'] / 1000
+        if jitter:
+            with self._lock:
+                latency += self.random.uniform(0, jitter)
+        return latency
+
+    def presigned(self, email):
+        """按邮箱哈希确定的"今日已签到"账号，与请求顺序无关"""
+        return zlib.crc32(email.encode('utf-8')) % 10000 < self.options['signed_rate'] * 10000
+
+    def checkin(self, email):
+        """执行签到，返回是否首次签到"""
+        with self._lock:
+            if email in self.signed or self.presigned(email):
+                self.signed.add(email)
+                return False
+            self.signed.add(email)
+            self.balances[email] = self.balances.get(email, self.options['initial_balance']) + self.options['reward']
+            return True
+
+    def balance(self, email):
+        with self._lock:
+            return self.balances.get(email, self.options['initial_balance'])
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # 头部和正文分两次写出，关闭Nagle避免与延迟ACK叠加出40ms的额外延迟
+    disable_nagle_algorithm = True
+    state = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, data):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        """读取请求正文 - 返回错误前也要读完，否则残留的正文会破坏keep-alive连接上的下一个请求"""
+        length = int(self.headers.get('Content-Length') or 0)
+        self.body = self.rfile.read(length) if length else b''
+
+    def read_json(self):
+        if not self.body:
+            return {}
+        try:
+            return json.loads(self.body)
+        except ValueError:
+            return {}
+
+    def authorized_email(self):
+        """校验Bearer token，返回邮箱；无效或过期时返回None"""
+        token = self.headers.get('Authorization', '')[len('Bearer '):]
+        try:
+            payload = token.split('.')[1]
+            claims = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+        except (IndexError, ValueError):
+            return None
+        if claims.get('exp', 0) < time.time():
+            return None
+        return claims.get('email')
+
+    def begin(self, method):
+        """记录请求并模拟延迟和随机错误，返回False时已发送503"""
+        path = self.path.split('?', 1)[0]
+        self.read_body()
+        if path.startswith('/__'):
+            return path
+        self.state.count(method, path)
+        delay = self.state.delay()
+        if delay:
+            time.sleep(delay)
+        if self.state.should_fail():
+            self.send_json(503, {"error": "Service Unavailable"})
+            return None
+        return path
+
+    def do_GET(self):
+        path = self.begin('GET')
+        if path is None:
+            return
+        if path == '/__stats':
+            return self.send_json(200, self.state.stats())
+
+        email = self.authorized_email()
+        if path in ('/api/auth/user', '/api/credits/balance') and email is None:
+            return self.send_json(401, {"error": "Unauthorized"})
+        if path == '/api/auth/user':
+            return self.send_json(200, {"email": email})
+        if path == '/api/credits/balance':
+            return self.send_json(200, {"balance": {"available": self.state.balance(email), "used": 0}})
+        self.send_json(404, {"error": "Not Found"})
+
+    def do_POST(self):
+        path = self.begin('POST')
+        if path is None:
+            return
+        data = self.read_json()
+        if path == '/__reset':
+            self.state.reset()
+            return self.send_json(200, {"success": True})
+
+        if path == '/api/auth/login':
+            if not data.get('email') or not data.get('password'):
+                return self.send_json(401, {"error": "Invalid credentials"})
+            return self.send_json(200, {"token": make_token(data['email'], self.state.options['token_ttl'])})
+
+        if path == '/api/checkin':
+            email = self.authorized_email()
+            if email is None:
+                return self.send_json(401, {"error": "Unauthorized"})
+            if self.state.checkin(email):
+                return self.send_json(200, {"success": True, "message": "签到成功", "reward": self.state.options['reward']})
+            return self.send_json(200, {"success": False, "message": "今日已签到"})
+        self.send_json(404, {"error": "Not Found"})
+
+
+def start_stub_server(**options):
+    """在后台线程启动模拟服务器，返回(server, state)；port为0时自动分配端口"""
+    options = dict(DEFAULT_OPTIONS, **options)
+    state = StubState(options)
+    handler = type('BoundStubHandler', (StubHandler,), {'state': state})
+    server = ThreadingHTTPServer((options['host'], options['port']), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="stub-server", daemon=True).start()
+    return server, state
+
+
+def main():
+    try:
+        options = parse_options(sys.argv[1:], DEFAULT_OPTIONS)
+    except ValueError as e:
+        print(e)
+        sys.exit(2)
+
+    server, state = start_stub_server(**options)
+    host, port = server.server_address[:2]
+    print(f"Stub server: http://{host}:{port} (latency {options['latency_ms']}ms, error rate {options['error_rate']})")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        print(json.dumps(state.stats(), ensure_ascii=False))
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
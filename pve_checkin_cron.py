@@ -5,21 +5,1839 @@ PVE Crontab 自动签到工具 - mirror.o3pro.pro
 适用于PVE环境的crontab定时任务，支持token失效重登录和SMTP邮件预警
 """
 
-import requests
 import json
+import atexit
+import base64
+import time
 import logging
-import smtplib
-from datetime import datetime, timedelta
+import logging.handlers
+import queue
+import sqlite3
+import copy
+import hashlib
+import random
+import signal
+import socket
+import itertools
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
 import sys
 import os
 import tempfile
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from email.header import Header
+
+# requests、smtplib、email和asyncio在用到时才导入，减少每次cron启动的耗时
+
+# 服务器按北京时间零点重置每日签到
+BEIJING_TZ = timezone(timedelta(hours=8))
+
+
+try:
+    import fcntl
+except ImportError:  # 没有fcntl的平台(如Windows)只使用进程内锁
+    fcntl = None
+
+
+@contextmanager
+def file_lock(lock_path):
+    """跨进程的排他文件锁，多个cron任务共享同一配置文件时串行化写入"""
+    if fcntl is None:
+        yield
+        return
+    with open(lock_path, 'a') as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def atomic_write_json(path, data):
+    """原子写入JSON文件 - 临时文件 + fsync + rename，读取方不会看到写了一半的文件"""
+    atomic_write_text(path, json.dumps(data, indent=2, ensure_ascii=False))
+
+
+def atomic_write_text(path, text, default_mode=None):
+    """原子写入文本文件，保留原文件权限；新文件使用default_mode(未指定时为mkstemp的600)"""
+    path = Path(path)
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{path.name}.", suffix=".tmp", dir=str(path.parent))
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        # 保留原文件权限(配置文件通常为600)
+        if path.exists():
+            os.chmod(tmp_path, path.stat().st_mode & 0o777)
+        elif default_mode is not None:
+            os.chmod(tmp_path, default_mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def merge_config_changes(base, ours, theirs):
+    """三方合并配置 - 本进程改过的字段以本进程为准，其余字段采用磁盘上的新值"""
+    if ours == base:
+        return copy.deepcopy(theirs)
+    if ours == theirs:
+        return copy.deepcopy(ours)
+    if isinstance(ours, dict) and isinstance(theirs, dict):
+        base = base if isinstance(base, dict) else {}
+        merged = {}
+        for key in list(ours) + [key for key in theirs if key not in ours]:
+            if key in ours and key in theirs:
+                merged[key] = merge_config_changes(base.get(key), ours[key], theirs[key])
+            else:
+                merged[key] = copy.deepcopy(ours[key] if key in ours else theirs[key])
+        return merged
+    if isinstance(ours, list) and isinstance(theirs, list) and isinstance(base, list) \
+            and len(ours) == len(theirs) == len(base):
+        return [merge_config_changes(b, o, t) for b, o, t in zip(base, ours, theirs)]
+    return copy.deepcopy(ours)
+
+
+def update_in_place(target, source):
+    """用source的内容原地更新target，保留嵌套dict的对象引用(账号实例持有accounts条目的引用)"""
+    for key in [key for key in target if key not in source]:
+        del target[key]
+    for key, value in source.items():
+        current = target.get(key)
+        if isinstance(current, dict) and isinstance(value, dict):
+            update_in_place(current, value)
+        elif isinstance(current, list) and isinstance(value, list) and len(current) == len(value) \
+                and all(isinstance(item, dict) for item in current + value):
+            for current_item, value_item in zip(current, value):
+                update_in_place(current_item, value_item)
+        else:
+            target[key] = value
+
+
+class StdlibResponse:
+    """标准库传输的响应，提供签到流程用到的requests.Response属性"""
+
+    def __init__(self, status_code, headers, content, url, timings=None):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.url = url
+        # 各阶段耗时(毫秒)和底层重试次数，见StdlibSession.request
+        self.timings = timings or {}
+
+    @property
+    def text(self):
+        content_type = self.headers.get('Content-Type', '')
+        encoding = 'utf-8'
+        if 'charset=' in content_type:
+            encoding = content_type.split('charset=', 1)[1].split(';')[0].strip() or encoding
+        return self.content.decode(encoding, errors='replace')
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class StdlibSession:
+    """只依赖http.client的HTTP会话 - 每个主机一个keep-alive连接池，无需导入requests
+
+    新建连接失败和复用的连接已被服务器关闭时可安全重试；GET请求遇到502/503/504
+    时按backoff_factor退避重试，与requests传输的重试策略一致。
+    新建连接时分别记录DNS解析、TCP连接和TLS握手的耗时，随响应的timings返回。
+    """
+
+    RETRY_STATUS = (502, 503, 504)
+
+    def __init__(self, pool_size=10, retries=2, backoff_factor=0.5, keep_alive=True):
+        self.pool_size = pool_size
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.keep_alive = keep_alive
+        self._pools = {}
+        self._lock = threading.Lock()
+        self._ssl_context = None
+
+    def get(self, url, headers=None, timeout=None):
+        return self.request('GET', url, headers=headers, timeout=timeout)
+
+    def post(self, url, headers=None, json=None, timeout=None):
+        return self.request('POST', url, headers=headers, json=json, timeout=timeout)
+
+    def request(self, method, url, headers=None, json=None, timeout=None):
+        import http.client
+        import json as json_module
+        from urllib.parse import urlsplit
+        
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = (parts.path or '/') + (f"?{parts.query}" if parts.query else '')
+        
+        headers = dict(headers or {})
+        # 标准库无法解码brotli
+        headers['Accept-Encoding'] = 'gzip, deflate'
+        if not self.keep_alive:
+            headers['Connection'] = 'close'
+        body = None
+        if json is not None:
+            body = json_module.dumps(json).encode('utf-8')
+            headers.setdefault('Content-Type', 'application/json')
+            
+        attempt = 0
+        while True:
+            try:
+                conn, timings = self._acquire(key, timeout)
+            except OSError:
+                if attempt >= self.retries:
+                    raise
+                attempt += 1
+                time.sleep(self.backoff_factor * (2 ** (attempt - 1)))
+                continue
+                
+            try:
+                sent = time.perf_counter()
+                conn.request(method, path, body=body, headers=headers)
+                response = conn.getresponse()
+                timings['ttfb_ms'] = elapsed_ms(sent)
+                content = response.read()
+            except (http.client.HTTPException, OSError) as e:
+                conn.close()
+                stale = timings['reused'] and isinstance(e, (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError))
+                if stale and attempt < self.retries:
+                    attempt += 1
+                    continue
+                raise
+                
+            if response.will_close or not self.keep_alive:
+                conn.close()
+            else:
+                self._release(key, conn)
+                
+            if method == 'GET' and response.status in self.RETRY_STATUS and attempt < self.retries:
+                attempt += 1
+                time.sleep(self.backoff_factor * (2 ** (attempt - 1)))
+                continue
+                
+            encoding = response.getheader('Content-Encoding', '').lower()
+            if encoding == 'gzip':
+                import gzip
+                content = gzip.decompress(content)
+            elif encoding == 'deflate':
+                import zlib
+                content = zlib.decompress(content)
+                
+            timings['retries'] = attempt
+            return StdlibResponse(response.status, response.headers, content, url, timings)
+
+    def _acquire(self, key, timeout):
+        """从连接池取出空闲连接，没有时新建并连接，返回(连接, 耗时记录)"""
+        import http.client
+        
+        with self._lock:
+            pool = self._pools.setdefault(key, [])
+            conn = pool.pop() if pool else None
+        if conn is not None:
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            return conn, {'reused': True}
+            
+        scheme, host, port = key
+        port = port or (443 if scheme == 'https' else 80)
+        timings = {'reused': False}
+        
+        # 分步建立连接以便分别计时: DNS解析 -> TCP连接(依次尝试解析出的地址) -> TLS握手
+        started = time.perf_counter()
+        addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        timings['dns_ms'] = elapsed_ms(started)
+        
+        started = time.perf_counter()
+        error = None
+        for *_, address in addresses:
+            try:
+                sock = socket.create_connection(address[:2], timeout)
+                break
+            except OSError as e:
+                error = e
+        else:
+            raise error
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        timings['connect_ms'] = elapsed_ms(started)
+        
+        if scheme == 'https':
+            if self._ssl_context is None:
+                import ssl
+                self._ssl_context = ssl.create_default_context()
+            started = time.perf_counter()
+            try:
+                sock = self._ssl_context.wrap_socket(sock, server_hostname=host)
+            except OSError:
+                sock.close()
+                raise
+            timings['tls_ms'] = elapsed_ms(started)
+            conn = http.client.HTTPSConnection(host, port, timeout=timeout, context=self._ssl_context)
+        else:
+            conn = http.client.HTTPConnection(host, port, timeout=timeout)
+        conn.sock = sock
+        return conn, timings
+
+    def _release(self, key, conn):
+        with self._lock:
+            pool = self._pools.setdefault(key, [])
+            if len(pool) < self.pool_size:
+                pool.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        """关闭连接池中的所有空闲连接"""
+        with self._lock:
+            pools, self._pools = self._pools, {}
+        for pool in pools.values():
+            for conn in pool:
+                conn.close()
+
+
+def elapsed_ms(started):
+    """从perf_counter时间点started到现在经过的毫秒数"""
+    return round((time.perf_counter() - started) * 1000, 2)
+
+
+def response_timings(response):
+    """取出响应的各阶段耗时和底层重试次数
+
+    标准库传输记录DNS、连接、TLS和首字节时间；requests传输只能得到首字节时间
+    (response.elapsed，新连接时包含建立连接的时间)和urllib3的重试次数。
+    """
+    timings = getattr(response, 'timings', None)
+    if timings is not None:
+        return timings
+    retries = getattr(getattr(response, 'raw', None), 'retries', None)
+    return {
+        'ttfb_ms': round(response.elapsed.total_seconds() * 1000, 2),
+        'retries': len(retries.history) if retries is not None else 0
+    }
+
+
+# 进程内共享的HTTP会话，所有API调用复用同一个连接池
+_http_session = None
+_http_session_lock = threading.Lock()
+
+
+def get_http_session(http_config=None):
+    """获取进程内共享的HTTP会话 - 连接池、keep-alive和重试适配器只创建一次
+
+    http.transport为"urllib"时使用只依赖标准库的StdlibSession，不导入requests；
+    默认的"requests"传输在requests未安装时也会退回标准库传输。
+    """
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            http_config = http_config or {}
+            retries = http_config.get('retries', 2)
+            pool_size = http_config.get('pool_size', 10)
+            
+            transport = http_config.get('transport', 'requests')
+            if transport == 'requests':
+                try:
+                    import requests
+                except ImportError:
+                    transport = 'urllib'
+                    
+            if transport == 'urllib':
+                _http_session = StdlibSession(
+                    pool_size=pool_size,
+                    retries=retries,
+                    backoff_factor=http_config.get('backoff_factor', 0.5),
+                    keep_alive=http_config.get('keep_alive', True)
+                )
+                return _http_session
+                
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+            
+            # 连接阶段的错误对所有方法都可安全重试，读取/状态码重试只用于幂等的GET
+            retry = Retry(
+                total=retries,
+                connect=retries,
+                read=retries,
+                status=retries,
+                backoff_factor=http_config.get('backoff_factor', 0.5),
+                status_forcelist=(502, 503, 504),
+                allowed_methods=frozenset(['GET', 'HEAD']),
+                raise_on_status=False
+            )
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+            
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            if not http_config.get('keep_alive', True):
+                session.headers['Connection'] = 'close'
+            _http_session = session
+        return _http_session
+
+
+def reset_http_session():
+    """关闭进程内共享的HTTP会话，下次get_http_session按新的http配置重新创建"""
+    global _http_session
+    with _http_session_lock:
+        session, _http_session = _http_session, None
+    if session is not None:
+        session.close()
+
+
+def preload_runtime_modules(config):
+    """按配置导入一次签到运行会用到的按需模块 - 供--profile-startup统计导入耗时"""
+    get_http_session(config.get('http'))
+    if config.get('accounts'):
+        import asyncio
+        import concurrent.futures
+    if config.get('email_alerts', {}).get('enabled', True):
+        import smtplib
+        import email.mime.multipart
+        import email.mime.text
+        import email.header
+
+
+def profile_startup(config_path=None, top=15, module="pve_checkin_cron"):
+    """在子进程中用 -X importtime 统计启动时各模块的导入耗时 - module为被统计的脚本模块名"""
+    import subprocess
+    
+    script_dir = Path(__file__).parent.absolute()
+    config_file = Path(config_path) if config_path else script_dir / "pve_checkin_config.json"
+    probe = (
+        "import json, os, sys; "
+        f"sys.path.insert(0, {str(script_dir)!r}); "
+        f"import {module}; "
+        "import pve_checkin_cron as m; "
+        f"path = {str(config_file)!r}; "
+        "m.preload_runtime_modules(json.load(open(path, encoding='utf-8')) if os.path.exists(path) else {})"
+    )
+    
+    started = time.perf_counter()
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', probe], capture_output=True, text=True)
+    wall_ms = (time.perf_counter() - started) * 1000
+    
+    rows = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        rows.append((name.strip(), depth, int(self_us), int(cumulative_us)))
+        
+    if proc.returncode != 0:
+        print(proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else "启动分析失败")
+        return 1
+        
+    total_ms = sum(row[2] for row in rows) / 1000
+    print(f"Startup profile: {len(rows)} modules, import {total_ms:.1f} ms, process {wall_ms:.1f} ms")
+    print(f"Config: {config_file}")
+    print("-" * 50)
+    print(f"{'cumulative ms':>14} {'self ms':>9}  top-level module")
+    for name, depth, self_us, cumulative_us in sorted(
+            (row for row in rows if row[1] == 0), key=lambda row: row[3], reverse=True)[:top]:
+        print(f"{cumulative_us / 1000:>14.1f} {self_us / 1000:>9.1f}  {name}")
+    return 0
+
+
+def decode_token_expiry(token):
+    """本地解析JWT的exp字段(不校验签名)，非JWT格式的token返回None"""
+    try:
+        parts = token.split('.')
+        if len(parts) != 3:
+            return None
+        payload = parts[1] + '=' * (-len(parts[1]) % 4)
+        claims = json.loads(base64.urlsafe_b64decode(payload))
+        expires_at = claims.get('exp')
+        if isinstance(expires_at, (int, float)):
+            return float(expires_at)
+    except Exception:
+        pass
+    return None
+
+
+def format_balance_info(balance_data):
+    """格式化积分信息 - balance_data为/api/credits/balance响应中的balance字段"""
+    if not balance_data:
+        return ""
+    available = balance_data.get('available', 0)
+    used = balance_data.get('used', 0)
+    total = available + used
+    return f"\n积分信息:\n  总积分: {total}\n  可用积分: {available}\n  已使用: {used}"
+
+
+class BalanceTracker:
+    """积分变化跟踪 - 避免签到前后各查询一次余额
+
+    获得的积分优先取签到响应中的奖励字段；没有时用签到后的余额与签到前的
+    基准余额比较。基准余额通常来自上次运行记录，按总积分(可用+已使用)比较，
+    不受两次运行之间消费积分的影响。
+
+    只识别明确表示"本次奖励"的字段，'points'这类字段在很多接口里是当前总积分。
+    有基准余额时奖励字段还要与余额差值核对，超过总积分增量的值不可信。
+    """
+
+    REWARD_KEYS = ('reward', 'earned', 'credits_earned', 'bonus')
+
+    def __init__(self, baseline=None):
+        self.baseline = baseline
+        self.after = None
+
+    @classmethod
+    def reward_from_result(cls, result):
+        """从签到响应中提取本次获得的积分，没有相关字段时返回None"""
+        if not isinstance(result, dict):
+            return None
+        for source in (result, result.get('data')):
+            if not isinstance(source, dict):
+                continue
+            for key in cls.REWARD_KEYS:
+                value = source.get(key)
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    return value
+        return None
+
+    @staticmethod
+    def total(balance_data):
+        return balance_data.get('available', 0) + balance_data.get('used', 0)
+
+    def earned(self, result):
+        """计算本次签到获得的积分，缺少基准余额无法计算时返回None"""
+        reward = self.reward_from_result(result)
+        if self.baseline and self.after:
+            difference = self.total(self.after) - self.total(self.baseline)
+            if reward is None or reward > difference:
+                return difference
+        if reward is not None:
+            return reward
+        message = result.get('message', '') if isinstance(result, dict) else ''
+        if '已签到' in message or '已经签到' in message:
+            return 0
+        return None
+
+    def credits_change(self, earned):
+        """返回签到前后的可用积分，用于日志和邮件"""
+        earned = earned or 0
+        if self.after:
+            after_credits = self.after.get('available', 0)
+            before_credits = self.baseline.get('available', 0) if self.baseline else after_credits - earned
+        else:
+            before_credits = self.baseline.get('available', 0) if self.baseline else 0
+            after_credits = before_credits + earned
+        return before_credits, after_credits
+
+
+class StatusStore:
+    """签到状态存储 - SQLite按(账号, 日期)建立主键索引
+
+    每次运行只写入当天这一条记录，"今天是否已签到"和"上次余额"都是索引查询，
+    不需要读取全部历史。过期记录按retention_days定期清理并压缩数据库文件。
+    """
+
+    # 单账号模式下的记录账号名
+    DEFAULT_ACCOUNT = "default"
+
+    # 状态记录中保留的原始响应长度，避免HTML错误页把数据库撑大
+    MAX_RAW_RESPONSE = 500
+
+    def __init__(self, path, retention_days=90, compact_interval_days=7):
+        self.path = Path(path)
+        self.retention_days = retention_days
+        self.compact_interval_days = compact_interval_days
+        self._lock = threading.Lock()
+        
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS checkins (
+                account TEXT NOT NULL,
+                day TEXT NOT NULL,
+                success INTEGER NOT NULL,
+                timestamp TEXT,
+                balance TEXT,
+                result TEXT,
+                PRIMARY KEY (account, day)
+            )
+        """)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS tokens (
+                email TEXT PRIMARY KEY,
+                token TEXT NOT NULL,
+                expires_at REAL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS metrics (
+                family TEXT NOT NULL,
+                suffix TEXT NOT NULL,
+                labels TEXT NOT NULL,
+                value REAL NOT NULL,
+                PRIMARY KEY (family, suffix, labels)
+            )
+        """)
+
+    def get(self, account, day):
+        """查询账号某天的签到记录"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT success, timestamp, balance, result FROM checkins WHERE account = ? AND day = ?",
+                (account, day)
+            ).fetchone()
+        if row is None:
+            return None
+        return {
+            "success": bool(row[0]),
+            "timestamp": row[1],
+            "balance": json.loads(row[2]) if row[2] else None,
+            "result": json.loads(row[3]) if row[3] else None
+        }
+
+    def latest(self, account):
+        """账号最近一条签到记录的(日期, 是否成功)，没有记录时返回None"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT day, success FROM checkins WHERE account = ? ORDER BY day DESC LIMIT 1",
+                (account,)
+            ).fetchone()
+        return (row[0], bool(row[1])) if row else None
+
+    def last_balance(self, account):
+        """查询账号最近一次记录的余额"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT balance FROM checkins WHERE account = ? AND balance IS NOT NULL ORDER BY day DESC LIMIT 1",
+                (account,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def record(self, account, day, entry):
+        """写入(覆盖)账号当天的签到记录"""
+        result = entry.get("result")
+        if isinstance(result, dict) and isinstance(result.get("raw_response"), str):
+            result = dict(result, raw_response=result["raw_response"][:self.MAX_RAW_RESPONSE])
+        balance = entry.get("balance")
+        
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO checkins (account, day, success, timestamp, balance, result) VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    account,
+                    day,
+                    int(bool(entry.get("success"))),
+                    entry.get("timestamp"),
+                    json.dumps(balance, ensure_ascii=False) if balance else None,
+                    json.dumps(result, ensure_ascii=False) if result is not None else None
+                )
+            )
+
+    def compact_if_due(self):
+        """按保留天数清理过期记录，每compact_interval_days天最多执行一次"""
+        today = datetime.now().date()
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = 'last_compact'").fetchone()
+            if row and (today - datetime.strptime(row[0], "%Y-%m-%d").date()).days < self.compact_interval_days:
+                return 0
+                
+            cutoff = (today - timedelta(days=self.retention_days)).strftime("%Y-%m-%d")
+            deleted = self._conn.execute("DELETE FROM checkins WHERE day < ?", (cutoff,)).rowcount
+            self._conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('last_compact', ?)",
+                (today.strftime("%Y-%m-%d"),)
+            )
+            if deleted:
+                self._conn.execute("VACUUM")
+        return deleted
+
+    def get_token(self, email):
+        """查询登录邮箱最近一次刷新得到的token"""
+        with self._lock:
+            row = self._conn.execute("SELECT token FROM tokens WHERE email = ?", (email,)).fetchone()
+        return row[0] if row else None
+
+    def put_token(self, email, token):
+        """记录登录邮箱新刷新的token，供其他进程和账号复用"""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO tokens (email, token, expires_at, updated_at) VALUES (?, ?, ?, ?)",
+                (email, token, decode_token_expiry(token), time.time())
+            )
+
+    def load_metrics(self):
+        """读取累计的指标样本，返回[(family, suffix, labels, value)]"""
+        with self._lock:
+            return self._conn.execute("SELECT family, suffix, labels, value FROM metrics ORDER BY rowid").fetchall()
+
+    def merge_metrics(self, deltas, gauges):
+        """在一个事务中累加计数器增量、覆盖仪表值，返回合并后的全部指标样本
+
+        多个进程(如cron和守护进程)共用状态库时计数器不会互相覆盖。
+        """
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany(
+                    "INSERT INTO metrics (family, suffix, labels, value) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (family, suffix, labels) DO UPDATE SET value = value + excluded.value",
+                    [key + (value,) for key, value in deltas.items()]
+                )
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO metrics (family, suffix, labels, value) VALUES (?, ?, ?, ?)",
+                    [key + (value,) for key, value in gauges.items()]
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            return self._conn.execute("SELECT family, suffix, labels, value FROM metrics ORDER BY rowid").fetchall()
+
+    def import_legacy_json(self, json_path):
+        """导入旧版pve_checkin_status.json("日期"或"日期:账号"为键)，导入后重命名原文件"""
+        json_path = Path(json_path)
+        if not json_path.exists():
+            return 0
+            
+        with open(json_path, 'r', encoding='utf-8') as f:
+            legacy = json.load(f)
+            
+        imported = 0
+        for key, entry in legacy.items():
+            if not isinstance(entry, dict):
+                continue
+            day, _, account = key.partition(':')
+            self.record(account or StatusStore.DEFAULT_ACCOUNT, day, entry)
+            imported += 1
+            
+        json_path.rename(json_path.with_name(json_path.name + ".migrated"))
+        return imported
+
+    def merge_segment(self, path):
+        """合并一个分片的状态库 - 签到记录按时间戳、token按更新时间保留较新者，返回(签到记录数, token数)
+
+        重复合并同一个分片不会产生重复记录。计数器指标由各分片各自导出，不参与合并。
+        """
+        with self._lock:
+            self._conn.execute("ATTACH DATABASE ? AS segment", (str(path),))
+            try:
+                self._conn.execute("BEGIN IMMEDIATE")
+                try:
+                    checkins = self._conn.execute("""
+                        INSERT INTO checkins (account, day, success, timestamp, balance, result)
+                        SELECT account, day, success, timestamp, balance, result FROM segment.checkins WHERE true
+                        ON CONFLICT (account, day) DO UPDATE SET
+                            success = excluded.success, timestamp = excluded.timestamp,
+                            balance = excluded.balance, result = excluded.result
+                        WHERE COALESCE(excluded.timestamp, '') > COALESCE(checkins.timestamp, '')
+                    """).rowcount
+                    tokens = self._conn.execute("""
+                        INSERT INTO tokens (email, token, expires_at, updated_at)
+                        SELECT email, token, expires_at, updated_at FROM segment.tokens WHERE true
+                        ON CONFLICT (email) DO UPDATE SET
+                            token = excluded.token, expires_at = excluded.expires_at, updated_at = excluded.updated_at
+                        WHERE excluded.updated_at > tokens.updated_at
+                    """).rowcount
+                    self._conn.execute("COMMIT")
+                except BaseException:
+                    self._conn.execute("ROLLBACK")
+                    raise
+            finally:
+                self._conn.execute("DETACH DATABASE segment")
+        return checkins, tokens
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def parse_shard(value):
+    """解析--shard的"i/N"(i从1开始)，返回(i, N)"""
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise ValueError(f"无效的分片: {value} (格式为 i/N，如 1/4)")
+    if count < 1 or not 1 <= index <= count:
+        raise ValueError(f"无效的分片: {value} (i应在1到N之间)")
+    return index, count
+
+
+def shard_owner(key, count):
+    """最高随机权重(rendezvous)哈希 - 返回key所属的分片(1..count)
+
+    账号的分片只取决于自身的key，增删其他账号不会让它换分片；分片数变化时也只有
+    约1/N的账号移动。
+    """
+    return max(range(1, count + 1), key=lambda shard: hashlib.sha256(f"{shard}:{key}".encode('utf-8')).digest())
+
+
+def spread_offset(key, window):
+    """账号在分散窗口内的固定偏移秒数 - 按key哈希均匀分布在[0, window)，每次运行都相同"""
+    fraction = int.from_bytes(hashlib.sha256(key.encode('utf-8')).digest()[:8], 'big') / 2 ** 64
+    return fraction * window
+
+
+def merge_status_segments(status_file):
+    """把同目录下各分片的状态库(如pve_checkin_status.shard-1-of-4.db)合并到status_file"""
+    status_file = Path(status_file)
+    segments = sorted(status_file.parent.glob(f"{status_file.stem}.shard-*-of-*{status_file.suffix}"))
+    store = StatusStore(status_file)
+    try:
+        return [(segment.name,) + store.merge_segment(segment) for segment in segments]
+    finally:
+        store.close()
+
+
+class NotificationDispatcher:
+    """通知队列 - 后台线程依次发送邮件，签到流程只负责入队，不等待SMTP服务器"""
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self.sent = 0
+        self.failed = 0
+
+    def submit(self, send_func, *args):
+        """加入发送队列，首次使用时启动后台线程"""
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._worker, name="notifier", daemon=True)
+                self._thread.start()
+        self._queue.put((send_func, args))
+
+    def _worker(self):
+        while True:
+            send_func, args = self._queue.get()
+            try:
+                if send_func(*args):
+                    self.sent += 1
+                else:
+                    self.failed += 1
+            except Exception:
+                self.failed += 1
+            finally:
+                self._queue.task_done()
+
+    def flush(self, timeout):
+        """等待队列发送完毕，超过timeout秒返回False(后台线程为daemon，不阻止进程退出)"""
+        deadline = time.monotonic() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+        return True
+
+    @property
+    def pending(self):
+        return self._queue.unfinished_tasks
+
+
+class Prefetch:
+    """在后台线程中提前执行一个只读查询，result()等待并返回结果(func需自行处理异常)"""
+
+    def __init__(self, func, *args):
+        self._result = None
+        self._thread = threading.Thread(target=self._run, args=(func,) + args, name="prefetch", daemon=True)
+        self._thread.start()
+
+    def _run(self, func, *args):
+        self._result = func(*args)
+
+    def result(self):
+        self._thread.join()
+        return self._result
+
+
+class SMTPTransport:
+    """复用的SMTP连接 - 一次运行中的所有邮件共用一个已登录的会话"""
+
+    def __init__(self, email_config, tracer):
+        self.config = email_config
+        self.tracer = tracer
+        self._server = None
+
+    def _connect(self, logger, parent, timeout):
+        import smtplib
+        
+        config = self.config
+        
+        # 根据端口选择连接方式
+        smtp_port = config['smtp_port']
+        logger.info(f"连接SMTP服务器: {config['smtp_server']}:{smtp_port}")
+        
+        if smtp_port == 465:
+            # SSL连接
+            with self.tracer.span("smtp.connect", parent=parent, tls=True):
+                server = smtplib.SMTP_SSL(config['smtp_server'], smtp_port, timeout=timeout)
+            logger.info("使用SSL连接")
+        else:
+            # STARTTLS连接
+            with self.tracer.span("smtp.connect", parent=parent, tls=False):
+                server = smtplib.SMTP(config['smtp_server'], smtp_port, timeout=timeout)
+            with self.tracer.span("smtp.starttls", parent=parent):
+                server.starttls()
+            logger.info("使用STARTTLS连接")
+            
+        logger.info("开始登录SMTP服务器")
+        with self.tracer.span("smtp.login", parent=parent):
+            server.login(config['smtp_user'], config['smtp_password'])
+        logger.info("SMTP登录成功")
+        self._server = server
+
+    def send(self, msg, logger, parent=None, timeout=None):
+        """发送邮件，连接被服务器关闭时重新连接一次；各步骤记录为parent的子span
+
+        发件人和收件人取自邮件的From/To头 - 同一SMTP登录的连接会被多个账号共用，
+        各账号可以单独设置from_email和to_email。timeout为本次发送的socket超时，默认为smtp_timeout。
+        """
+        import smtplib
+        from email.utils import getaddresses
+        
+        timeout = timeout or self.config.get('smtp_timeout', 20)
+        recipients = [address for _, address in getaddresses(msg.get_all('To', []))]
+        for attempt in range(2):
+            if self._server is None:
+                self._connect(logger, parent, timeout)
+            elif self._server.sock is not None:
+                self._server.sock.settimeout(timeout)
+            try:
+                with self.tracer.span("smtp.send", parent=parent, reconnected=bool(attempt)):
+                    self._server.sendmail(msg['From'], recipients, msg.as_string())
+                return
+            except smtplib.SMTPServerDisconnected:
+                self._server = None
+                if attempt:
+                    raise
+                logger.info("SMTP连接已断开，重新连接")
+
+    def close(self):
+        if self._server is None:
+            return
+        try:
+            self._server.quit()
+        except Exception:
+            pass
+        self._server = None
+
+
+class CassetteError(Exception):
+    """回放时录制文件中没有对应的交互"""
+
+
+class Cassette:
+    """HTTP和SMTP交互的录制文件 - 录制时按发生顺序保存每次交互的响应和耗时，回放时不访问网络
+
+    回放时同一方法和路径(或SMTP发送)的交互按录制顺序依次返回；timing为"original"时按录制的
+    耗时等待，"zero"时立即返回。只保存响应，不保存请求内容(密码、Authorization头)，
+    但登录响应中的token会被保存，录制文件应与配置文件一样妥善保管。
+    """
+
+    VERSION = 1
+    # 签到流程会读取的响应头，其他响应头不保存
+    HEADERS = ('Content-Type', 'Date', 'Retry-After')
+
+    def __init__(self, path, replay=False, timing="original"):
+        self.path = Path(path)
+        self.replay = replay
+        self.timing = timing
+        self.interactions = []
+        self._pending = {}
+        self._lock = threading.Lock()
+        # 录制开始的时间戳 - 回放时把token过期判断所用的时钟拨回这一时刻
+        self.started_at = time.time()
+        if replay:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') != self.VERSION:
+                raise ValueError(f"不支持的录制文件版本: {data.get('version')}")
+            self.started_at = data.get('started_at', self.started_at)
+            self.interactions = data['interactions']
+            for interaction in self.interactions:
+                self._pending.setdefault(self._key(interaction), []).append(interaction)
+
+    @staticmethod
+    def _key(interaction):
+        if interaction['type'] == 'smtp':
+            return ('smtp',)
+        return ('http', interaction['method'], interaction['path'])
+
+    def record(self, interaction):
+        with self._lock:
+            self.interactions.append(interaction)
+
+    def next(self, key):
+        """回放: 取出key的下一个录制交互，按录制的耗时等待"""
+        with self._lock:
+            pending = self._pending.get(key)
+            interaction = pending.pop(0) if pending else None
+        if interaction is None:
+            raise CassetteError(f"录制文件中没有更多的 {' '.join(key)} 交互")
+        if self.timing == 'original':
+            time.sleep(interaction.get('elapsed_ms', 0) / 1000)
+        return interaction
+
+    @property
+    def unused(self):
+        """回放结束后未被使用的交互数"""
+        return sum(len(pending) for pending in self._pending.values())
+
+    def save(self):
+        # 每个交互一行，便于比较两次录制
+        lines = ",\n".join(json.dumps(interaction, ensure_ascii=False) for interaction in self.interactions)
+        header = json.dumps({
+            "version": self.VERSION,
+            "recorded_at": datetime.fromtimestamp(self.started_at).isoformat(),
+            "started_at": self.started_at
+        }, ensure_ascii=False)[:-1]
+        atomic_write_text(self.path, f"{header}, \"interactions\": [\n{lines}\n]}}\n")
+
+
+class CassetteSession:
+    """录制或回放HTTP交互的会话，接口与StdlibSession.request相同 - 录制时请求由session发出"""
+
+    def __init__(self, cassette, session=None):
+        self.cassette = cassette
+        self.session = session
+
+    def request(self, method, url, headers=None, json=None, timeout=None):
+        from urllib.parse import urlsplit
+        
+        parts = urlsplit(url)
+        path = (parts.path or '/') + (f"?{parts.query}" if parts.query else '')
+        if self.cassette.replay:
+            return self._replay(self.cassette.next(('http', method, path)), url)
+            
+        interaction = {"type": "http", "method": method, "path": path}
+        started = time.perf_counter()
+        try:
+            response = self.session.request(method, url, headers=headers, json=json, timeout=timeout)
+        except Exception as e:
+            # 回放时按是否可重试还原为对应的异常
+            interaction.update(
+                error="connection" if RetryPolicy().is_retryable(e) else "fatal",
+                message=f"{type(e).__name__}: {e}",
+                elapsed_ms=elapsed_ms(started)
+            )
+            self.cassette.record(interaction)
+            raise
+        interaction.update(
+            status=response.status_code,
+            headers={name: response.headers[name] for name in Cassette.HEADERS if response.headers.get(name)},
+            elapsed_ms=elapsed_ms(started)
+        )
+        try:
+            interaction['body'] = response.content.decode('utf-8')
+        except UnicodeDecodeError:
+            interaction['body_b64'] = base64.b64encode(response.content).decode('ascii')
+        self.cassette.record(interaction)
+        return response
+
+    @staticmethod
+    def _replay(interaction, url):
+        import http.client
+        
+        if interaction.get('error') == 'connection':
+            raise ConnectionError(interaction['message'])
+        if interaction.get('error'):
+            raise CassetteError(interaction['message'])
+            
+        headers = http.client.HTTPMessage()
+        for name, value in interaction.get('headers', {}).items():
+            headers[name] = value
+        if 'body_b64' in interaction:
+            content = base64.b64decode(interaction['body_b64'])
+        else:
+            content = interaction.get('body', '').encode('utf-8')
+        return StdlibResponse(interaction['status'], headers, content, url, {'replayed': True})
+
+
+class CassetteSMTPTransport(SMTPTransport):
+    """录制或回放SMTP发送的传输 - 回放时不连接SMTP服务器"""
+
+    def __init__(self, email_config, tracer, cassette):
+        super().__init__(email_config, tracer)
+        self.cassette = cassette
+
+    def send(self, msg, logger, parent=None, timeout=None):
+        if self.cassette.replay:
+            with self.tracer.span("smtp.send", parent=parent, replayed=True):
+                interaction = self.cassette.next(('smtp',))
+            if interaction.get('error'):
+                import smtplib
+                raise smtplib.SMTPException(interaction['error'])
+            return
+            
+        interaction = {"type": "smtp", "subject": str(msg['Subject'])}
+        started = time.perf_counter()
+        try:
+            super().send(msg, logger, parent, timeout)
+        except Exception as e:
+            interaction['error'] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            interaction['elapsed_ms'] = elapsed_ms(started)
+            self.cassette.record(interaction)
+
+    def close(self):
+        if not self.cassette.replay:
+            super().close()
+
+
+class RetryPolicy:
+    """签到重试策略 - 区分可重试和永久失败，指数退避加随机抖动，总等待不超过整次运行的时间预算"""
+
+    # 可重试的HTTP状态码，其他4xx(如登录密码错误)视为永久失败
+    RETRYABLE_STATUS = frozenset([408, 425, 429, 500, 502, 503, 504])
+
+    def __init__(self, max_retries=3, base_delay=10, max_delay=300, budget=900):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = time.monotonic() + budget
+
+    def is_retryable(self, failure):
+        """failure为最近一次失败的HTTP状态码或异常，None表示业务失败(不重试)"""
+        if failure is None:
+            return False
+        if isinstance(failure, BaseException):
+            # requests的异常都继承自OSError，需要先按requests的类型区分
+            requests = sys.modules.get('requests')
+            if requests is not None and isinstance(failure, requests.exceptions.RequestException):
+                return isinstance(failure, (
+                    requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout,
+                    requests.exceptions.ChunkedEncodingError
+                ))
+            # 标准库传输: 连接错误、超时和连接被中断
+            import http.client
+            return isinstance(failure, (OSError, http.client.HTTPException))
+        return failure in self.RETRYABLE_STATUS
+
+    def next_delay(self, attempt, minimum=None):
+        """第attempt次(从0开始)重试前的等待秒数，超过重试次数或时间预算时返回None
+
+        minimum为服务器Retry-After要求的最短等待秒数。
+        """
+        if attempt >= self.max_retries:
+            return None
+        ceiling = min(self.max_delay, self.base_delay * (2 ** attempt))
+        delay = ceiling / 2 + random.uniform(0, ceiling / 2)
+        if minimum:
+            delay = max(delay, minimum)
+        if time.monotonic() + delay >= self.deadline:
+            return None
+        return delay
+
+
+class TokenLocks:
+    """token刷新的单飞锁 - 同一登录邮箱同时只有一个调用方执行登录
+
+    进程内用threading.Lock区分线程，跨进程用锁目录中按邮箱哈希命名的文件锁；
+    不同邮箱的刷新互不阻塞。
+    """
+
+    def __init__(self, lock_dir):
+        self.lock_dir = Path(lock_dir)
+        self._locks = {}
+        self._guard = threading.Lock()
+
+    @contextmanager
+    def hold(self, email):
+        with self._guard:
+            lock = self._locks.setdefault(email, threading.Lock())
+        with lock:
+            self.lock_dir.mkdir(exist_ok=True)
+            digest = hashlib.sha1(email.encode('utf-8')).hexdigest()[:16]
+            with file_lock(self.lock_dir / f"{digest}.lock"):
+                yield
+
+
+def parse_retry_after(value):
+    """解析Retry-After头(秒数或HTTP日期)，返回等待秒数，无法解析时返回None"""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    from email.utils import parsedate_to_datetime
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+def sleep_until(target):
+    """睡眠到本机时间戳target - 分段睡眠，避免长时间睡眠的误差累积"""
+    while True:
+        remaining = target - time.time()
+        if remaining <= 0:
+            return
+        time.sleep(min(remaining, 1.0))
+
+
+class ClockSkew:
+    """按HTTP Date头估计服务器时钟与本机时钟的偏差(服务器减本机，秒)
+
+    Date头只精确到秒：响应说明服务器时间在[D, D+1)内，而服务器生成响应的本机时刻在请求
+    发出和收到响应之间，因此偏差落在(D-收到时刻, D+1-发出时刻)内。请求间隔不取整秒时，
+    多个样本的区间取交集可以把误差缩小到接近往返时间的一半。
+    """
+
+    def __init__(self):
+        self.lower = float('-inf')
+        self.upper = float('inf')
+        self.samples = 0
+        self.conflicts = 0
+
+    def add(self, sent, received, date_header):
+        """加入一个样本，sent/received为请求发出和收到响应的本机时间戳；Date头无法解析时返回False"""
+        if not date_header:
+            return False
+        from email.utils import parsedate_to_datetime
+        try:
+            server = parsedate_to_datetime(date_header).timestamp()
+        except (TypeError, ValueError):
+            return False
+        lower, upper = server - received, server + 1 - sent
+        self.samples += 1
+        if max(lower, self.lower) > min(upper, self.upper):
+            # 与之前的样本矛盾(负载均衡后的服务器时钟不一致或本机时钟被调整)，以新样本为准
+            self.conflicts += 1
+            self.lower, self.upper = lower, upper
+        else:
+            self.lower, self.upper = max(lower, self.lower), min(upper, self.upper)
+        return True
+
+    @property
+    def offset(self):
+        return (self.lower + self.upper) / 2
+
+    @property
+    def error(self):
+        return (self.upper - self.lower) / 2
+
+
+class TokenBucket:
+    """令牌桶 - rate为每秒请求数(0表示不限速)，burst为桶容量；block用于按Retry-After暂停"""
+
+    def __init__(self, rate=0, burst=0):
+        self.rate = rate
+        self.capacity = burst or max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """预约一个令牌，返回调用方需要等待的秒数(令牌可以预支，多个线程按预约顺序排队)"""
+        with self._lock:
+            now = time.monotonic()
+            wait = max(0.0, self.blocked_until - now)
+            if self.rate > 0:
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                self.tokens -= 1
+                if self.tokens < 0:
+                    wait = max(wait, -self.tokens / self.rate)
+            return wait
+
+    def block(self, seconds):
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class ConcurrencyGovernor:
+    """AIMD并发控制 - 请求正常时并发上限每轮加1，出现429、5xx、连接错误或高延迟时减半
+
+    上限在minimum和maximum之间浮动；减半之后cooldown秒内不再减半，避免同一波错误把
+    并发一直压到最低。
+    """
+
+    def __init__(self, maximum, minimum=1, cooldown=1.0):
+        self.maximum = max(1, maximum)
+        self.minimum = max(1, min(minimum, self.maximum))
+        self.cooldown = cooldown
+        self.limit = float(self.maximum)
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self, congested):
+        with self._condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if congested:
+                if now - self._last_decrease >= self.cooldown:
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self._last_decrease = now
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+
+class RateLimiter:
+    """进程内所有API调用共享的限速器 - 全局令牌桶、按接口的令牌桶和AIMD并发控制"""
+
+    def __init__(self, config, max_concurrency):
+        self.config = config
+        self.global_bucket = TokenBucket(config.get('rate', 0), config.get('burst', 0))
+        self.buckets = {path: TokenBucket(rate) for path, rate in config.get('endpoints', {}).items()}
+        self.target_latency = config.get('target_latency_ms', 3000) / 1000
+        self.governor = ConcurrencyGovernor(max_concurrency) if config.get('aimd', True) else None
+        self._lock = threading.Lock()
+
+    def bucket(self, endpoint):
+        with self._lock:
+            if endpoint not in self.buckets:
+                self.buckets[endpoint] = TokenBucket()
+            return self.buckets[endpoint]
+
+    @contextmanager
+    def request(self, endpoint):
+        """占用一个并发名额并等待令牌；调用方把响应状态码写入yield的dict，用于调整并发"""
+        if self.governor is not None:
+            self.governor.acquire()
+        slot = {"status": None}
+        started = None
+        try:
+            wait = max(self.global_bucket.reserve(), self.bucket(endpoint).reserve())
+            if wait > 0:
+                time.sleep(wait)
+            slot["waited_ms"] = round(wait * 1000, 2)
+            started = time.monotonic()
+            yield slot
+        finally:
+            if self.governor is not None:
+                status = slot["status"]
+                latency = time.monotonic() - started if started is not None else 0
+                congested = status is None or status == 429 or status >= 500 or latency > self.target_latency
+                self.governor.release(congested)
+
+    def throttle(self, seconds):
+        """服务器要求等待(429/503的Retry-After)时暂停所有接口"""
+        self.global_bucket.block(min(seconds, self.config.get('max_retry_after', 300)))
+
+    @property
+    def concurrency_limit(self):
+        return int(self.governor.limit) if self.governor is not None else None
+
+
+class CircuitOpenError(Exception):
+    """熔断器打开期间的请求直接失败，不访问服务器"""
+
+    def __init__(self, retry_in):
+        super().__init__(f"服务中断(熔断器已打开)，{retry_in:.0f} 秒后探测恢复")
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """base_url的熔断器 - 连续failure_threshold次连接错误或5xx后打开，打开期间请求直接失败
+
+    打开reset_timeout秒后进入半开状态，只放行一个探测请求: 探测成功则关闭，失败则重新打开。
+    failure_threshold为0时不启用。
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=60):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """是否放行请求 - 半开状态下同时只放行一个探测请求"""
+        if self.failure_threshold <= 0:
+            return True
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def retry_in(self):
+        """距离下次探测的秒数"""
+        with self._lock:
+            if self.state != self.OPEN:
+                return 0.0
+            return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+
+    def record(self, healthy):
+        """记录请求结果，熔断器从关闭变为打开时返回OPEN，恢复关闭时返回CLOSED，否则返回None"""
+        if self.failure_threshold <= 0:
+            return None
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._probing = False
+            if healthy:
+                self.failures = 0
+                if self.state != self.CLOSED:
+                    self.state = self.CLOSED
+                    return self.CLOSED
+                return None
+                
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                opened = self.state == self.CLOSED
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                return self.OPEN if opened else None
+            return None
+
+
+class DeadlineExceeded(Exception):
+    """剩余时间不足以完成调用，调用被跳过"""
+
+
+class Deadline:
+    """截止时间 - 单个账号的截止时间不晚于整次运行的截止时间，seconds为0表示不限
+
+    每次调用的超时取配置的超时和剩余时间中的较小者；剩余时间不足MIN_CALL_SECONDS时
+    调用直接跳过，不再发出注定超时的请求。
+    """
+
+    MIN_CALL_SECONDS = 1.0
+
+    def __init__(self, seconds=0, parent=None):
+        self.expires_at = time.monotonic() + seconds if seconds else None
+        if parent is not None and parent.expires_at is not None:
+            self.expires_at = parent.expires_at if self.expires_at is None else min(self.expires_at, parent.expires_at)
+
+    def remaining(self):
+        """剩余秒数，不限时返回None"""
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self):
+        remaining = self.remaining()
+        return remaining is not None and remaining < self.MIN_CALL_SECONDS
+
+    def check(self, what):
+        if self.expired:
+            raise DeadlineExceeded(f"已超过截止时间，跳过{what}")
+
+    def cap(self, timeout, minimum=None):
+        """单次调用的超时 - 不超过剩余时间(至少minimum秒，默认MIN_CALL_SECONDS)"""
+        remaining = self.remaining()
+        if remaining is None:
+            return timeout
+        return min(timeout, max(remaining, minimum or self.MIN_CALL_SECONDS))
+
+
+class CheckinRun:
+    """单个账号一次签到任务的进度，在多次重试之间保存"""
+
+    def __init__(self, today):
+        self.today = today
+        self.tracker = None
+        self.success = False
+        self.result = None
+        self.attempts = 0
+        # 本次签到获得的积分(未知时为None)
+        self.earned = None
+        # 下次重试前的等待秒数，None表示不再重试
+        self.retry_delay = None
+        # 今日已签到等无需再执行的情况
+        self.finished = False
+
+
+class TimerWheel:
+    """按一天中的秒数分槽的定时轮 - 守护进程每秒推进一次游标，取出到期槽位中的任务"""
+
+    SLOTS = 24 * 60 * 60
+
+    def __init__(self):
+        self.slots = {}
+        self.cursor = None
+        # 游标所在的日期，用于区分跨过午夜和时钟回拨
+        self.day = None
+
+    @staticmethod
+    def second_of_day(moment):
+        return moment.hour * 3600 + moment.minute * 60 + moment.second
+
+    def schedule(self, second, job):
+        self.slots.setdefault(second % self.SLOTS, []).append(job)
+
+    def advance(self, moment):
+        """把游标推进到时刻moment，返回经过的槽位中的任务
+
+        日期变化时从游标走到当天结束再从0点继续；同一天内时间倒退(NTP校正或手动调整时钟)
+        时只把游标移回，不触发任务，回拨的这段时间内的任务到点后照常触发。
+        """
+        second = self.second_of_day(moment)
+        day, self.day = self.day, moment.date()
+        if self.cursor is None or day is None or moment.date() < day or (moment.date() == day and second < self.cursor):
+            self.cursor = second
+            return []
+            
+        due = []
+        position = self.cursor
+        while position != second:
+            position = (position + 1) % self.SLOTS
+            due.extend(self.slots.get(position, []))
+        self.cursor = second
+        return due
+
+    def jobs_before(self, second):
+        """当天second之前(不含)已经错过的任务"""
+        return [job for slot, jobs in sorted(self.slots.items()) if slot < second for job in jobs]
+
+
+class Tracer:
+    """耗时追踪 - 收集每次运行中账号、API调用和SMTP步骤的span，通过parent_id组成树
+
+    span是普通的dict，调用方可以在with块中补充属性(状态码、重试次数等)；
+    结束的span暂存在内存中，由drain取出后写入--trace指定的JSON lines文件。
+    """
+
+    def __init__(self):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self._spans = []
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def new_trace(self):
+        """开始新的一次运行，之后创建的span使用新的trace_id"""
+        self.trace_id = uuid.uuid4().hex[:16]
+        return self.trace_id
+
+    @contextmanager
+    def span(self, name, parent=None, **attributes):
+        span = {
+            "trace_id": parent["trace_id"] if parent else self.trace_id,
+            "span_id": next(self._ids),
+            "parent_id": parent["span_id"] if parent else None,
+            "name": name,
+            "start": round(time.time(), 3)
+        }
+        span.update(attributes)
+        started = time.perf_counter()
+        try:
+            yield span
+        except Exception as e:
+            span.setdefault("error", f"{type(e).__name__}: {e}")
+            raise
+        finally:
+            span["duration_ms"] = elapsed_ms(started)
+            with self._lock:
+                self._spans.append(span)
+
+    def drain(self):
+        """取出并清空已结束的span"""
+        with self._lock:
+            spans, self._spans = self._spans, []
+        return spans
+
+
+class MetricsRegistry:
+    """Prometheus指标 - 以Prometheus文本格式或OpenMetrics格式输出
+
+    样本以(指标族, 后缀, 标签)为键。计数器和直方图的增量记在pending中，由状态库累加后
+    写回(见StatusStore.merge_metrics)，每次cron运行的.prom文件都是跨运行的累计值；
+    仪表(gauge)直接覆盖。
+    """
+
+    # 指标族名称 -> (类型, 说明)
+    FAMILIES = {
+        "pve_checkin_checkins": ("counter", "签到结果次数，result为success、failure或skipped(今日已签到)"),
+        "pve_checkin_token_refreshes": ("counter", "重新登录刷新token的次数"),
+        "pve_checkin_requests": ("counter", "API请求次数，按接口和HTTP状态码(异常为error)"),
+        "pve_checkin_request_duration_seconds": ("histogram", "API请求总耗时"),
+        "pve_checkin_credits_balance": ("gauge", "最近一次记录的总积分"),
+        "pve_checkin_credits_earned": ("gauge", "最近一次签到获得的积分"),
+        "pve_checkin_last_success_timestamp_seconds": ("gauge", "最近一次签到成功的时间"),
+        "pve_checkin_last_run_timestamp_seconds": ("gauge", "最近一次运行结束的时间"),
+        "pve_checkin_run_duration_seconds": ("gauge", "最近一次运行的耗时"),
+        "pve_checkin_notification_queue_depth": ("gauge", "通知队列中等待发送的邮件数"),
+        "pve_checkin_concurrency_limit": ("gauge", "AIMD调整后的当前请求并发上限"),
+        "pve_checkin_circuit_open": ("gauge", "熔断器是否打开(服务中断)")
+    }
+
+    LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self):
+        self._samples = {}
+        self._pending = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _labels(labels):
+        escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+        return ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped))
+
+    def _add(self, key, value):
+        self._samples[key] = self._samples.get(key, 0) + value
+        self._pending[key] = self._pending.get(key, 0) + value
+
+    def inc(self, family, value=1, **labels):
+        with self._lock:
+            self._add((family, "_total", self._labels(labels)), value)
+
+    def set(self, family, value, **labels):
+        key = (family, "", self._labels(labels))
+        with self._lock:
+            self._samples[key] = self._gauges[key] = value
+
+    def observe(self, family, value, **labels):
+        """记录一次直方图观测值，首次观测时创建全部桶"""
+        with self._lock:
+            for bound in self.LATENCY_BUCKETS:
+                self._add((family, "_bucket", self._labels(dict(labels, le=bound))), 1 if value <= bound else 0)
+            self._add((family, "_bucket", self._labels(dict(labels, le="+Inf"))), 1)
+            self._add((family, "_sum", self._labels(labels)), value)
+            self._add((family, "_count", self._labels(labels)), 1)
+
+    def take_pending(self):
+        """取出并清空尚未持久化的(计数器增量, 仪表值)"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            gauges, self._gauges = self._gauges, {}
+        return pending, gauges
+
+    def load(self, rows):
+        """用状态库中的累计样本替换内存中的样本"""
+        with self._lock:
+            self._samples = {(family, suffix, labels): value for family, suffix, labels, value in rows}
+            for key, value in self._pending.items():
+                self._samples[key] = self._samples.get(key, 0) + value
+            self._samples.update(self._gauges)
+
+    def render(self, openmetrics=False):
+        """输出文本格式；openmetrics为True时计数器的TYPE使用族名并以# EOF结尾"""
+        with self._lock:
+            samples = list(self._samples.items())
+            
+        lines = []
+        for family, (metric_type, help_text) in self.FAMILIES.items():
+            family_samples = [(key, value) for key, value in samples if key[0] == family]
+            if not family_samples:
+                continue
+            name = family + "_total" if metric_type == "counter" and not openmetrics else family
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for (_, suffix, labels), value in family_samples:
+                label_text = f"{{{labels}}}" if labels else ""
+                lines.append(f"{family}{suffix}{label_text} {float(value)!r}")
+        if openmetrics:
+            lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+
+class AccountLoggerAdapter(logging.LoggerAdapter):
+    """为批量模式下的日志记录加上account字段 - 文本日志显示为账号前缀，JSON日志为单独的字段"""
+
+    def process(self, msg, kwargs):
+        kwargs['extra'] = dict(kwargs.get('extra') or {}, **self.extra)
+        return msg, kwargs
+
+
+class AccountFormatter(logging.Formatter):
+    """文本日志 - 带account字段的记录在消息前加上[账号]前缀"""
+
+    def formatMessage(self, record):
+        account = getattr(record, 'account', None)
+        if account:
+            record = copy.copy(record)
+            record.message = f"[{account}] {record.message}"
+        return super().formatMessage(record)
+
+
+class JsonLogFormatter(logging.Formatter):
+    """JSON lines日志 - 每条记录一行，包含时间、级别、线程、消息以及account等附加字段"""
+
+    # LogRecord自带的属性，其余属性来自extra
+    STANDARD = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            "level": record.levelname,
+            "thread": record.threadName,
+            "message": record.getMessage()
+        }
+        entry.update((key, value) for key, value in vars(record).items() if key not in self.STANDARD)
+        # 经过LogQueueHandler的记录只保留已格式化的exc_text
+        exc_text = record.exc_text or (self.formatException(record.exc_info) if record.exc_info else None)
+        if exc_text:
+            entry['exc_info'] = exc_text
+        if record.stack_info:
+            entry['stack_info'] = record.stack_info
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """日志入队前只合并消息和参数 - 异常堆栈格式化为exc_text单独保留，由各handler的formatter处理
+
+    QueueHandler默认把堆栈拼进消息并清除exc_info，JSON日志就无法单独记录exc_info字段。
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            # 入队时就格式化堆栈，不让队列中的记录持有traceback及其栈帧
+            record.exc_text = record.exc_text or logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class RotatingLogHandler(logging.handlers.WatchedFileHandler):
+    """按周期和大小轮转的日志文件，换下的日志用gzip压缩
+
+    当前日志为<prefix>_<周期>.log(周期为月份YYYYMM或日期YYYYMMDD)。当前文件超过max_bytes时
+    改名为<prefix>_<周期>.log.N并压缩，之后写入新文件；每次创建新的日志文件时压缩之前周期的
+    日志，并删除超过max_days天的旧日志 - 日志目录只在轮转时扫描，启动时不扫描。
+    多个进程写同一日志时轮转在文件锁内进行，其他进程写下一条日志时发现文件已换下并重新打开。
+    """
+
+    PERIODS = {"month": "%Y%m", "day": "%Y%m%d"}
+
+    def __init__(self, directory, prefix="pve_checkin", period="month", max_bytes=0, max_days=30):
+        self.directory = Path(directory)
+        self.prefix = prefix
+        self.pattern = self.PERIODS.get(period, self.PERIODS["month"])
+        self.max_bytes = max_bytes
+        self.max_days = max_days
+        self.lock_path = self.directory / f".{prefix}_log.lock"
+        self.period = datetime.now().strftime(self.pattern)
+        super().__init__(self.path_for(self.period), encoding='utf-8', delay=True)
+
+    def path_for(self, period):
+        return self.directory / f"{self.prefix}_{period}.log"
+
+    def emit(self, record):
+        try:
+            period = datetime.fromtimestamp(record.created).strftime(self.pattern)
+            if period != self.period:
+                # 进入新的周期，下一次打开时创建新文件并压缩上一个周期的日志
+                self._close_stream()
+                self.period = period
+                self.baseFilename = os.path.abspath(self.path_for(period))
+            elif self.max_bytes and self.stream is not None and self.stream.tell() >= self.max_bytes:
+                self._rotate()
+        except Exception:
+            self.handleError(record)
+        super().emit(record)
+
+    def _open(self):
+        with file_lock(self.lock_path):
+            created = not os.path.exists(self.baseFilename)
+            stream = super()._open()
+            if created:
+                self._housekeeping()
+        stat = os.fstat(stream.fileno())
+        self.dev, self.ino = stat.st_dev, stat.st_ino
+        return stream
+
+    def _close_stream(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
+    def _rotate(self):
+        """当前文件超过max_bytes - 改名并压缩(其他进程已经轮转过时只重新打开)"""
+        self._close_stream()
+        current = Path(self.baseFilename)
+        with file_lock(self.lock_path):
+            try:
+                if current.stat().st_size < self.max_bytes:
+                    return
+            except FileNotFoundError:
+                return
+            used = [path.name[len(current.name) + 1:-3] for path in self.directory.glob(f"{current.name}.*.gz")]
+            index = 1 + max((int(suffix) for suffix in used if suffix.isdigit()), default=0)
+            rotated = current.with_name(f"{current.name}.{index}")
+            current.rename(rotated)
+            self._compress(rotated)
+
+    @staticmethod
+    def _compress(path):
+        import gzip
+        import shutil
+        with open(path, 'rb') as source, gzip.open(f"{path}.gz", 'wb') as target:
+            shutil.copyfileobj(source, target)
+        os.unlink(path)
+
+    def _housekeeping(self):
+        """压缩之前周期的日志，删除超过保留天数的日志 - 调用方持有文件锁
+
+        max_days为0时不处理旧日志(交给logrotate等外部工具管理)。
+        """
+        if self.max_days <= 0:
+            return
+        cutoff = time.time() - self.max_days * 86400
+        current = os.path.basename(self.baseFilename)
+        for path in self.directory.glob(f"{self.prefix}_*"):
+            if path.name == current or not path.name.endswith(('.log', '.gz')):
+                continue
+            try:
+                if path.stat().st_mtime < cutoff:
+                    path.unlink()
+                elif path.suffix == '.log':
+                    self._compress(path)
+            except OSError:
+                continue
+
+
+_log_listener = None
+
+
+def start_log_listener(handlers, level):
+    """日志记录放入队列，由后台线程写入handlers - 业务线程只做入队，不等待磁盘写入和轮转"""
+    global _log_listener
+    stop_log_listener()
+    log_queue = queue.SimpleQueue()
+    _log_listener = logging.handlers.QueueListener(log_queue, *handlers)
+    _log_listener.start()
+    logging.basicConfig(level=level, handlers=[LogQueueHandler(log_queue)], force=True)
+
+
+def stop_log_listener():
+    """停止日志线程 - 写完队列中剩余的日志后关闭各handler"""
+    global _log_listener
+    if _log_listener is None:
+        return
+    _log_listener.stop()
+    for handler in _log_listener.handlers:
+        handler.close()
+    _log_listener = None
+
+
+# 进程退出前写完队列中的日志
+atexit.register(stop_log_listener)
+
 
 class PVECheckinCron:
-    def __init__(self, config_path=None):
+    # 批量模式下多个账号线程共享的配置写入锁
+    _config_lock = threading.Lock()
+
+    def __init__(self, config_path=None, shard=None, log_dir=None):
         # 确定配置文件路径 - 优先使用传入路径，然后是脚本目录，最后是当前目录
         if config_path:
             self.config_file = Path(config_path)
@@ -27,17 +1845,82 @@ class PVECheckinCron:
             script_dir = Path(__file__).parent.absolute()
             self.config_file = script_dir / "pve_checkin_config.json"
             
-        self.status_file = self.config_file.parent / "pve_checkin_status.json"
-        self.log_file = self.config_file.parent / f"pve_checkin_{datetime.now().strftime('%Y%m')}.log"
+        self.lock_file = self.config_file.parent / f"{self.config_file.name}.lock"
+        self.token_locks = TokenLocks(self.config_file.parent / ".token_locks")
+        self.status_file = self.config_file.parent / "pve_checkin_status.db"
+        
+        # 分片运行(i, N)时只签到属于本分片的账号，状态写入本分片自己的状态库
+        self.shard = shard
+        if shard:
+            self.status_file = self.status_file.with_name(f"pve_checkin_status.shard-{shard[0]}-of-{shard[1]}.db")
+        # 日志目录默认为配置文件所在目录(录制和回放时配置文件在临时目录中，日志仍写入原目录)
+        self.log_dir = Path(log_dir) if log_dir else self.config_file.parent
+        self.log_file = self.log_dir / f"pve_checkin_{datetime.now().strftime('%Y%m')}.log"
+        
+        # token过期判断所用时钟与本机时钟的差(秒)，回放录制文件时设为录制时刻与现在的差
+        self.clock_offset = 0.0
+        
+        # 批量模式下由account_view设置
+        self.account = None
+        self.account_name = None
+        
+        # 最近一次读取或写入磁盘的配置内容
+        self._persisted_config = None
+        
+        # 最近一次请求失败的HTTP状态码或异常，用于判断是否可重试
+        self.last_failure = None
+        self.retry_policy = None
+        # 后台查询中的签到前余额 (BalanceTracker, Prefetch)，签到请求发出前取回
+        self.pending_baseline = None
+        # 最近一次429/503响应要求的等待秒数(Retry-After)
+        self.last_retry_after = None
+        # 零点签到前预热时查询的签到前余额 {账号名: balance}
+        self.rollover_baselines = {}
+        # 零点签到前预热时已验证的token，零点后不再请求/api/auth/user (各账号实例共享)
+        self.prewarmed_tokens = set()
+        # 签到状态记录的日期，None时按本机日期；零点签到时设为服务器(北京时间)的日期
+        self.checkin_day = None
+        # 录制或回放HTTP/SMTP交互的录制文件，见use_cassette
+        self.cassette = None
         
-        self.base_url = "https://mirror.o3pro.pro"
+        # 整次运行和当前账号的截止时间，由run_checkin和run_batch按timeouts配置设置
+        self.run_deadline = Deadline()
+        self.deadline = self.run_deadline
+        
+        # 耗时追踪 - trace_span为当前账号(或整次运行)的span，API和SMTP调用记录为它的子span
+        self.tracer = Tracer()
+        self.trace_span = None
+        self.trace_file = None
+        
+        # Prometheus指标(批量模式下所有账号共享)
+        self.metrics = MetricsRegistry()
         
         # 加载配置
         self.load_config()
         
+        # 接口地址可配置为本地模拟服务器(见mirror_stub_server.py)
+        self.base_url = self.config['base_url'].rstrip('/')
+        
         # 设置日志
         self.setup_logging()
         
+        # 状态存储
+        self.status_store = self.open_status_store()
+        self.compact_status_store()
+        
+        # 启用指标导出时从状态库恢复累计的计数器
+        if self.metrics_enabled:
+            self.metrics.load(self.status_store.load_metrics())
+        
+        # 邮件通知队列、SMTP连接和摘要事件(批量模式下所有账号共享)
+        self.notifier = NotificationDispatcher()
+        self._smtp_transports = {}
+        self.digest_events = []
+        self._digest_lock = threading.Lock()
+        
+        # HTTP连接池、限速器和熔断器
+        self.setup_connections()
+        
         # 设置基础请求头
         self.base_headers = {
             'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
@@ -49,6 +1932,39 @@ class PVECheckinCron:
             'Content-Type': 'application/json'
         }
         
+    def setup_connections(self):
+        """按配置创建HTTP会话、限速器和熔断器(批量模式下所有账号共享)"""
+        # 共享的HTTP连接池 - 批量模式下连接池至少容纳所有并发账号
+        http_config = dict(self.config['http'])
+        http_config['pool_size'] = max(http_config.get('pool_size', 10), self.config['batch'].get('concurrency', 10))
+        self.session = get_http_session(http_config)
+        
+        # 所有账号共享的限速器，并发上限不超过批量并发数
+        self.rate_limiter = RateLimiter(self.config['rate_limit'], self.config['batch'].get('concurrency', 10))
+        
+        # 服务中断时的熔断器
+        breaker_config = self.config['circuit_breaker']
+        self.circuit_breaker = CircuitBreaker(
+            failure_threshold=breaker_config.get('failure_threshold', 5) if breaker_config.get('enabled', True) else 0,
+            reset_timeout=breaker_config.get('reset_timeout', 60)
+        )
+        
+    def reload_config(self):
+        """重新加载配置文件，并按新配置重建接口地址、日志、HTTP会话、限速器、熔断器和状态保留设置
+
+        守护进程在两次签到之间调用，此时没有进行中的请求。指标服务的端口在启动时绑定，修改后需要重启。
+        """
+        self.load_config()
+        self.base_url = self.config['base_url'].rstrip('/')
+        self.setup_logging()
+        
+        status_config = self.config['status']
+        self.status_store.retention_days = status_config.get('retention_days', 90)
+        self.status_store.compact_interval_days = status_config.get('compact_interval_days', 7)
+        
+        reset_http_session()
+        self.setup_connections()
+        
     def load_config(self):
         """加载配置文件"""
         default_config = {
@@ -57,13 +1973,80 @@ class PVECheckinCron:
                 "password": "your_mirroro3_login_password"
             },
             "auth_token": "your_mirroro3_auth_token",
+            "base_url": "https://mirror.o3pro.pro",
             "user_info": {
                 "id": 0,
                 "username": "your_username",
                 "email": "your_email@example.com"
             },
+            "accounts": [],
+            "batch": {
+                "concurrency": 10
+            },
+            "token": {
+                "local_check": True,
+                "refresh_margin": 3600,
+                "shared_cache": True
+            },
+            "http": {
+                "transport": "requests",
+                "pool_size": 10,
+                "keep_alive": True,
+                "retries": 2,
+                "backoff_factor": 0.5
+            },
+            "circuit_breaker": {
+                "enabled": True,
+                "failure_threshold": 5,
+                "reset_timeout": 60,
+                "on_open": "defer"
+            },
+            "rate_limit": {
+                "rate": 0,
+                "burst": 0,
+                "endpoints": {
+                    "/api/auth/login": 2
+                },
+                "aimd": True,
+                "target_latency_ms": 3000,
+                "max_retry_after": 300
+            },
+            "schedule": {
+                "spread_window": 0,
+                "jitter": 0,
+                "failed_first": True
+            },
+            "rollover": {
+                "fire_delay_ms": 200,
+                "prewarm_seconds": 15,
+                "skew_samples": 8,
+                "max_wait": 3600
+            },
+            "timeouts": {
+                "run": 0,
+                "account": 0,
+                "login": 30,
+                "request": 10
+            },
+            "status": {
+                "retention_days": 90,
+                "compact_interval_days": 7
+            },
+            "daemon": {
+                "checkin_time": "09:00",
+                "catch_up": True
+            },
+            "metrics": {
+                "textfile": "",
+                "port": 0,
+                "bind": "127.0.0.1"
+            },
             "max_retries": 3,
             "retry_delay": 300,
+            "retry": {
+                "base_delay": 10,
+                "budget": 900
+            },
             "email_alerts": {
                 "enabled": True,
                 "smtp_server": "smtp.gmail.com",
@@ -74,11 +2057,18 @@ class PVECheckinCron:
                 "to_email": "your_notification_email@example.com",
                 "on_failure": True,
                 "on_success": False,
-                "on_token_refresh": True
+                "on_token_refresh": True,
+                "digest": False,
+                "smtp_timeout": 20,
+                "flush_timeout": 60,
+                "flush_grace": 10
             },
             "logging": {
                 "level": "INFO",
-                "max_log_days": 30
+                "max_log_days": 30,
+                "format": "text",
+                "period": "month",
+                "max_bytes": 10485760
             }
         }
         
@@ -86,6 +2076,8 @@ class PVECheckinCron:
             try:
                 with open(self.config_file, 'r', encoding='utf-8') as f:
                     loaded_config = json.load(f)
+                    # 磁盘上的配置内容，用于判断是否需要写回和合并并发修改
+                    self._persisted_config = copy.deepcopy(loaded_config)
                     # 递归合并配置，保留默认值
                     self.config = self._merge_config(default_config, loaded_config)
             except Exception as e:
@@ -94,7 +2086,10 @@ class PVECheckinCron:
         else:
             self.config = default_config
             
-        # 自动保存配置（确保有完整配置）
+        # 完整配置(批量模式下各账号实例共享，保存时写回此对象)
+        self.root_config = self.config
+            
+        # 补全缺失的默认配置项 - 内容没有变化时不写文件
         self.save_config()
             
     def _merge_config(self, default, loaded):
@@ -108,76 +2103,215 @@ class PVECheckinCron:
         return result
             
     def save_config(self):
-        """保存配置文件"""
+        """保存配置文件 - 仅在内容变化时写入，加锁后与磁盘上的最新版本合并再原子替换"""
+        # 账号实例的token写回accounts列表中对应的条目
+        if self.account is not None:
+            self.account["auth_token"] = self.config["auth_token"]
+            
         try:
-            with open(self.config_file, 'w', encoding='utf-8') as f:
-                json.dump(self.config, f, indent=2, ensure_ascii=False)
+            with self._config_lock, file_lock(self.lock_file):
+                disk_config = self._read_config_file()
+                
+                # 其他进程在本进程读取之后修改过配置文件，合并双方的修改
+                if disk_config is not None and disk_config != self._persisted_config:
+                    merged = merge_config_changes(self._persisted_config, self.root_config, disk_config)
+                    update_in_place(self.root_config, merged)
+                    
+                if self.root_config != disk_config:
+                    atomic_write_json(self.config_file, self.root_config)
+                self._persisted_config = copy.deepcopy(self.root_config)
         except Exception as e:
             print(f"保存配置失败: {e}")
             
-    def setup_logging(self):
-        """配置日志系统 - PVE环境优化"""
-        log_level = getattr(logging, self.config['logging']['level'], logging.INFO)
-        log_format = '%(asctime)s - %(levelname)s - %(message)s'
+    def _read_config_file(self):
+        """读取磁盘上的配置文件，不存在或无法解析时返回None"""
+        try:
+            with open(self.config_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+            
+    @staticmethod
+    def account_label(account):
+        """账号名称 - 优先使用name字段，否则使用登录邮箱"""
+        return account.get('name') or account.get('login', {}).get('email', 'unknown')
         
-        # 清理旧日志文件
-        self._cleanup_old_logs()
+    def account_view(self, account):
+        """为accounts中的单个账号创建签到实例，共享配置文件、日志和状态文件"""
+        worker = copy.copy(self)
+        worker.account = account
+        worker.account_name = self.account_label(account)
         
-        # 配置日志处理器
-        handlers = [
-            logging.FileHandler(self.log_file, encoding='utf-8')
-        ]
+        # 账号条目中的字段覆盖全局配置(如login、email_alerts.to_email)；token和用户信息属于
+        # 单个账号，不从全局配置继承 - 没有token的账号用自己的login验证或登录
+        shared_config = {
+            key: value for key, value in self.root_config.items()
+            if key not in ('accounts', 'auth_token', 'user_info')
+        }
+        worker.config = self._merge_config(shared_config, account)
+        worker.config.setdefault('auth_token', '')
         
-        # 如果是测试模式或交互式环境，也输出到控制台
-        if '--test' in sys.argv or os.isatty(sys.stdout.fileno()):
-            handlers.append(logging.StreamHandler(sys.stdout))
+        worker.logger = AccountLoggerAdapter(self.logger, {'account': worker.account_name})
+        return worker
+            
+    def setup_logging(self):
+        """配置日志系统 - 日志经队列由后台线程写入，批量模式下各账号线程不争用日志文件"""
+        logging_config = self.config['logging']
+        log_level = getattr(logging, logging_config['level'], logging.INFO)
+        text_formatter = AccountFormatter('%(asctime)s - %(levelname)s - %(message)s')
         
-        logging.basicConfig(
-            level=log_level,
-            format=log_format,
-            handlers=handlers,
-            force=True
+        # 日志文件按周期和大小轮转，轮转时压缩并清理过期日志
+        file_handler = RotatingLogHandler(
+            self.log_dir,
+            period=logging_config.get('period', 'month'),
+            max_bytes=logging_config.get('max_bytes', 10485760),
+            max_days=logging_config.get('max_log_days', 30)
         )
+        file_handler.setFormatter(JsonLogFormatter() if logging_config.get('format') == 'json' else text_formatter)
+        self.log_file = Path(file_handler.baseFilename)
+        handlers = [file_handler]
         
+        # 如果是测试模式或交互式环境，也输出到控制台
+        if '--test' in sys.argv or os.isatty(sys.stdout.fileno()):
+            console_handler = logging.StreamHandler(sys.stdout)
+            console_handler.setFormatter(text_formatter)
+            handlers.append(console_handler)
+            
+        start_log_listener(handlers, log_level)
         self.logger = logging.getLogger(__name__)
         
-    def _cleanup_old_logs(self):
-        """清理过期日志文件"""
-        try:
-            max_days = self.config['logging']['max_log_days']
-            cutoff_date = datetime.now() - timedelta(days=max_days)
-            
-            log_pattern = "pve_checkin_*.log"
-            for log_file in self.config_file.parent.glob(log_pattern):
-                if log_file.stat().st_mtime < cutoff_date.timestamp():
-                    log_file.unlink()
-                    
-        except Exception as e:
-            pass  # 静默处理清理错误
-            
     def get_auth_headers(self):
         """获取带认证的请求头"""
         headers = self.base_headers.copy()
         headers['Authorization'] = f'Bearer {self.config["auth_token"]}'
         return headers
         
+    def _api_request(self, method, path, **kwargs):
+        """调用API并记录耗时span - DNS、连接、TLS、首字节、总耗时、状态码和底层重试次数
+
+        请求前经过限速器排队，排队时间记录为span的queued_ms，不计入请求耗时。
+        熔断器打开时不发出请求，直接抛出CircuitOpenError；当前账号的剩余时间不足时抛出
+        DeadlineExceeded。超时默认为timeouts.request，并且不超过剩余时间。
+        """
+        timeout = kwargs.pop('timeout', None) or self.config['timeouts'].get('request', 10)
+        self.deadline.check(f"{method} {path}")
+        
+        if not self.circuit_breaker.allow():
+            self.metrics.inc("pve_checkin_requests", endpoint=path, status="circuit_open")
+            raise CircuitOpenError(self.circuit_breaker.retry_in())
+            
+        status = "error"
+        try:
+            with self.rate_limiter.request(path) as slot:
+                try:
+                    with self.tracer.span("http", parent=self.trace_span, account=self.status_account,
+                                          method=method, endpoint=path, queued_ms=slot["waited_ms"]) as span:
+                        # 超时按排队之后的剩余时间计算
+                        response = self.session.request(method, f"{self.base_url}{path}",
+                                                        timeout=self.deadline.cap(timeout), **kwargs)
+                        status = slot["status"] = span["status"] = response.status_code
+                        span.update(response_timings(response))
+                finally:
+                    self.metrics.inc("pve_checkin_requests", endpoint=path, status=status)
+                    self.metrics.observe("pve_checkin_request_duration_seconds", round(span["duration_ms"] / 1000, 6), endpoint=path)
+        finally:
+            self.record_circuit(status)
+                
+        if response.status_code in (429, 503):
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            if retry_after:
+                self.last_retry_after = retry_after
+                self.rate_limiter.throttle(retry_after)
+                self.logger.warning(f"服务器限流({response.status_code})，所有请求暂停 {retry_after:.0f} 秒")
+            
+        self.logger.debug(
+            f"{method} {path} -> {response.status_code}, 耗时 {span['duration_ms']}ms "
+            f"(DNS {span.get('dns_ms')}, 连接 {span.get('connect_ms')}, TLS {span.get('tls_ms')}, "
+            f"首字节 {span.get('ttfb_ms')}, 重试 {span.get('retries')})"
+        )
+        return response
+        
+    def record_circuit(self, status):
+        """把请求结果计入熔断器 - 熔断器打开时发送一封服务中断通知，恢复时发送恢复通知"""
+        healthy = isinstance(status, int) and status < 500
+        transition = self.circuit_breaker.record(healthy)
+        if transition is None:
+            return
+            
+        breaker = self.circuit_breaker
+        if transition == CircuitBreaker.OPEN:
+            message = (
+                f"连续 {breaker.failures} 次请求失败(连接错误或5xx，最近一次: {status})，"
+                f"暂停访问 {self.base_url}，{breaker.reset_timeout} 秒后探测恢复。\n"
+                f"中断期间签到失败的账号不再单独发送失败邮件。"
+            )
+            self.logger.error(f"服务中断: {message}")
+            if self.config['email_alerts'].get('on_failure', True):
+                self._send_email_alert("服务中断", message, "error")
+        else:
+            self.logger.info(f"服务已恢复: {self.base_url}")
+            if self.config['email_alerts'].get('on_failure', True):
+                self._send_email_alert("服务已恢复", f"{self.base_url} 探测请求成功，签到恢复正常。", "info")
+                
     def login_and_get_token(self):
+        """获取新的token - 同一邮箱只有一个调用方真正登录，其他调用方等待后复用它的结果
+
+        多个cron任务或批量模式下的多个账号同时发现token过期时，避免集中登录触发风控。
+        """
+        if not self.config['token'].get('shared_cache', True):
+            return self._login()
+            
+        stale_token = self.config.get('auth_token')
+        with self.token_locks.hold(self.config['login']['email']):
+            # 等待期间其他调用方可能已经完成登录
+            if self.adopt_cached_token(stale_token):
+                return True
+            return self._login()
+            
+    def adopt_cached_token(self, current_token, proactive=False):
+        """改用token缓存中其他调用方刷新的token，缓存中的token更新且未过期时返回True
+
+        proactive为True时(当前token尚未验证失败)只在两者都是JWT且缓存中的过期更晚时替换 - 非JWT
+        的token无法比较新旧，用户刚写入配置文件的token不能被缓存中旧的token覆盖。
+        """
+        try:
+            cached = self.status_store.get_token(self.config['login']['email'])
+        except sqlite3.Error as e:
+            self.logger.error(f"读取token缓存失败: {e}")
+            return False
+        if not cached or cached == current_token:
+            return False
+            
+        cached_expiry = decode_token_expiry(cached)
+        current_expiry = decode_token_expiry(current_token or '')
+        if proactive and (cached_expiry is None or current_expiry is None):
+            return False
+        if cached_expiry is not None:
+            if cached_expiry <= self.now() or (current_expiry is not None and current_expiry >= cached_expiry):
+                return False
+                
+        self.config["auth_token"] = cached
+        self.save_config()
+        self.logger.info("使用token缓存中已刷新的token")
+        return True
+        
+    def _login(self):
         """登录获取新的token"""
         try:
             self.logger.info("尝试重新登录获取token...")
             
             # 登录API
-            login_url = f"{self.base_url}/api/auth/login"
             login_data = {
                 "email": self.config["login"]["email"],
                 "password": self.config["login"]["password"]
             }
             
-            response = requests.post(
-                login_url, 
+            response = self._api_request(
+                'POST',
+                "/api/auth/login",
                 headers=self.base_headers, 
                 json=login_data, 
-                timeout=30
+                timeout=self.config['timeouts'].get('login', 30)
             )
             
             if response.status_code == 200:
@@ -189,6 +2323,12 @@ class PVECheckinCron:
                     # 更新配置中的token
                     self.config["auth_token"] = new_token
                     self.save_config()
+                    if self.config['token'].get('shared_cache', True):
+                        try:
+                            self.status_store.put_token(self.config['login']['email'], new_token)
+                        except sqlite3.Error as e:
+                            self.logger.error(f"写入token缓存失败: {e}")
+                    self.metrics.inc("pve_checkin_token_refreshes", account=self.status_account)
                     
                     self.logger.info("登录成功，已更新token")
                     
@@ -203,18 +2343,19 @@ class PVECheckinCron:
                     self.logger.error(f"登录响应中未找到token: {result}")
                     return False
             else:
+                self.last_failure = response.status_code
                 self.logger.error(f"登录失败: {response.status_code} - {response.text}")
                 return False
                 
         except Exception as e:
+            self.last_failure = e
             self.logger.error(f"登录过程出错: {e}")
             return False
             
     def check_token_validity(self):
         """检查Token有效性"""
         try:
-            url = f"{self.base_url}/api/auth/user"
-            response = requests.get(url, headers=self.get_auth_headers(), timeout=10)
+            response = self._api_request('GET', "/api/auth/user", headers=self.get_auth_headers())
             
             if response.status_code == 200:
                 user_data = response.json()
@@ -225,15 +2366,44 @@ class PVECheckinCron:
                 self.logger.warning("Token已失效")
                 return False
             else:
+                self.last_failure = response.status_code
                 self.logger.error(f"Token验证失败: {response.status_code}")
                 return False
                 
         except Exception as e:
+            self.last_failure = e
             self.logger.error(f"Token验证出错: {e}")
             return False
             
     def ensure_valid_token(self):
         """确保token有效，失效时自动重新登录"""
+        token_config = self.config.get('token', {})
+        
+        # 其他进程或账号可能已经刷新过同一邮箱的token；非JWT的token在验证失败后才使用缓存
+        if token_config.get('shared_cache', True):
+            self.adopt_cached_token(self.config.get('auth_token'), proactive=True)
+            
+        # 零点签到前刚预热过的token不再验证，签到接口返回401时仍会重新登录
+        if self.config.get('auth_token') in self.prewarmed_tokens:
+            self.logger.info("Token已在预热时验证")
+            return True
+            
+        expires_at = decode_token_expiry(self.config.get('auth_token') or '')
+        
+        # JWT可在本地判断过期时间，剩余时间充足时跳过/api/auth/user请求
+        if token_config.get('local_check', True) and expires_at is not None:
+            remaining = expires_at - self.now()
+            if remaining > token_config.get('refresh_margin', 3600):
+                self.logger.info(f"Token本地校验有效，剩余 {remaining / 3600:.1f} 小时")
+                return True
+                
+            self.logger.info("Token即将过期，提前重新登录" if remaining > 0 else "Token已过期，重新登录")
+            if self.login_and_get_token():
+                return True
+            # 提前刷新失败时，尚未过期的token仍交给服务器验证
+            return remaining > 0 and self.check_token_validity()
+            
+        # 非JWT格式的token只能由服务器验证
         if self.check_token_validity():
             return True
             
@@ -242,13 +2412,25 @@ class PVECheckinCron:
         
     def perform_checkin(self):
         """执行签到"""
+        self.last_failure = None
+        self.last_retry_after = None
         try:
             # 确保token有效
             if not self.ensure_valid_token():
                 return False, {"error": "无法获取有效的认证token"}
                 
-            url = f"{self.base_url}/api/checkin"
-            response = requests.post(url, headers=self.get_auth_headers(), json={}, timeout=10)
+            # 签到会改变余额，签到前余额必须在签到请求之前取回
+            if not self.resolve_baseline():
+                return False, {"error": "Token已失效且重新登录失败"}
+                
+            response = self._api_request('POST', "/api/checkin", headers=self.get_auth_headers(), json={})
+            
+            # 本地校验通过但服务器已吊销token时，重新登录后重试一次
+            if response.status_code == 401:
+                self.logger.warning("签到接口返回401，重新登录后重试")
+                if not self.login_and_get_token():
+                    return False, {"error": "Token已失效且重新登录失败"}
+                response = self._api_request('POST', "/api/checkin", headers=self.get_auth_headers(), json={})
             
             if response.status_code == 200:
                 try:
@@ -268,6 +2450,7 @@ class PVECheckinCron:
                     self.logger.info("签到成功! (无JSON响应)")
                     return True, {"message": "签到成功"}
             else:
+                self.last_failure = response.status_code
                 try:
                     # 尝试解析错误响应的JSON
                     error_result = response.json()
@@ -279,26 +2462,73 @@ class PVECheckinCron:
                     return False, {"error": f"HTTP {response.status_code}", "raw_response": response.text}
                 
         except Exception as e:
+            self.last_failure = e
             self.logger.error(f"签到请求出错: {e}")
             return False, {"error": str(e)}
             
     def get_credits_balance(self):
         """查询积分余额"""
         try:
-            url = f"{self.base_url}/api/credits/balance"
-            response = requests.get(url, headers=self.get_auth_headers(), timeout=10)
+            response = self._api_request('GET', "/api/credits/balance", headers=self.get_auth_headers())
             
             if response.status_code == 200:
                 return response.json()
             else:
                 return None
                 
+        except DeadlineExceeded as e:
+            self.logger.warning(f"积分查询: {e}")
+            return None
         except Exception as e:
             self.logger.error(f"积分查询出错: {e}")
             return None
             
+    def fetch_balance_data(self):
+        """查询积分余额，返回响应中的balance字段"""
+        balance = self.get_credits_balance()
+        if balance and isinstance(balance.get('balance'), dict):
+            return balance['balance']
+        return None
+        
+    def prefetch_baseline(self):
+        """查询签到前余额，返回(balance字段, HTTP状态码, 使用的token) - 在后台线程中与token验证并行执行"""
+        token = self.config.get('auth_token')
+        try:
+            response = self._api_request('GET', "/api/credits/balance", headers=self.get_auth_headers())
+        except Exception as e:
+            self.logger.warning(f"签到前积分查询出错: {e}")
+            return None, None, token
+            
+        balance = None
+        if response.status_code == 200:
+            try:
+                balance = response.json().get('balance')
+            except (ValueError, AttributeError):
+                pass
+        return (balance if isinstance(balance, dict) else None), response.status_code, token
+        
+    def resolve_baseline(self):
+        """取回后台查询的签到前余额 - 余额接口返回401时，若token未被刷新过则重新登录，然后再查一次
+
+        重新登录失败时返回False。
+        """
+        if self.pending_baseline is None:
+            return True
+        tracker, prefetch = self.pending_baseline
+        self.pending_baseline = None
+        
+        balance, status, token = prefetch.result()
+        if status == 401:
+            if token == self.config.get('auth_token'):
+                self.logger.warning("积分接口返回401，重新登录")
+                if not self.login_and_get_token():
+                    return False
+            balance = self.fetch_balance_data()
+        tracker.baseline = balance
+        return True
+            
     def _send_email_alert(self, subject, body, alert_type="info"):
-        """发送邮件预警"""
+        """发送邮件预警 - 邮件放入通知队列由后台线程发送，不阻塞签到流程"""
         email_config = self.config.get('email_alerts', {})
         
         if not email_config.get('enabled', False):
@@ -312,21 +2542,53 @@ class PVECheckinCron:
             self.logger.warning(f"邮件配置不完整，缺少字段: {missing_fields}，跳过邮件发送")
             return
             
+        # 超过整次运行的截止时间后只发送失败通知(用户最需要知道的正是超时失败)，其他邮件不再入队
+        if self.run_deadline.expired and alert_type != "error":
+            self.logger.warning(f"已超过运行截止时间，跳过邮件: {subject}")
+            return
+            
+        account = self.account_name or self.config['login'].get('email', 'Unknown')
+        
+        # 摘要模式下只记录事件，运行结束时合并为一封邮件(测试邮件除外)
+        if email_config.get('digest', False) and alert_type != "test":
+            with self._digest_lock:
+                self.digest_events.append({
+                    "time": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                    "account": account,
+                    "subject": subject,
+                    "body": body,
+                    "type": alert_type,
+                    "email_config": email_config
+                })
+            self.logger.info(f"邮件事件加入摘要: {subject}, 类型: {alert_type}")
+            return
+            
         try:
-            self.logger.info(f"准备发送邮件: {subject}, 类型: {alert_type}")
+            self.logger.info(f"邮件加入发送队列: {subject}, 类型: {alert_type}")
+            msg = self._build_email(email_config, subject, body, alert_type, account)
+            self.notifier.submit(self._deliver_email, email_config, msg, subject, self.logger, self.trace_span)
             
-            # 创建邮件
-            msg = MIMEMultipart()
-            msg['From'] = email_config['from_email']
-            msg['To'] = email_config['to_email']
-            msg['Subject'] = Header(f"[PVE签到工具] {subject}", 'utf-8')
+        except Exception as e:
+            self.logger.error(f"创建邮件失败: {e}")
             
-            # 邮件正文
-            full_body = f"""
+    def _build_email(self, email_config, subject, body, alert_type, account):
+        """创建邮件"""
+        from email.header import Header
+        from email.mime.multipart import MIMEMultipart
+        from email.mime.text import MIMEText
+        
+        msg = MIMEMultipart()
+        msg['From'] = email_config['from_email']
+        msg['To'] = email_config['to_email']
+        msg['Subject'] = Header(f"[PVE签到工具] {subject}", 'utf-8')
+        
+        # 邮件正文
+        full_body = f"""
 PVE签到工具状态通知
 
 时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
 类型: {alert_type}
+账号: {account}
 
 {body}
 
@@ -335,82 +2597,271 @@ PVE签到工具状态通知
 配置文件: {self.config_file}
 日志文件: {self.log_file}
 """
+        
+        msg.attach(MIMEText(full_body, 'plain', 'utf-8'))
+        return msg
+        
+    def _deliver_email(self, email_config, msg, subject, logger, parent=None):
+        """通过复用的SMTP连接发送邮件 - 在通知队列的后台线程中执行，耗时记录为parent的子span"""
+        key = (email_config['smtp_server'], email_config['smtp_port'], email_config['smtp_user'])
+        transport = self._smtp_transports.get(key)
+        if transport is None:
+            if self.cassette is not None:
+                transport = CassetteSMTPTransport(email_config, self.tracer, self.cassette)
+            else:
+                transport = SMTPTransport(email_config, self.tracer)
+            self._smtp_transports[key] = transport
             
-            msg.attach(MIMEText(full_body, 'plain', 'utf-8'))
+        try:
+            with self.tracer.span("smtp", parent=parent, subject=subject) as span:
+                timeout = self.run_deadline.cap(email_config.get('smtp_timeout', 20), email_config.get('flush_grace', 10))
+                transport.send(msg, logger, span, timeout=timeout)
+            logger.info(f"邮件发送成功: {subject}")
+            return True
             
-            # 根据端口选择连接方式
-            smtp_port = email_config['smtp_port']
-            self.logger.info(f"连接SMTP服务器: {email_config['smtp_server']}:{smtp_port}")
+        except Exception as e:
+            logger.error(f"发送邮件失败: {e}")
+            import traceback
+            logger.error(f"详细错误: {traceback.format_exc()}")
+            transport.close()
+            return False
             
-            if smtp_port == 465:
-                # SSL连接
-                server = smtplib.SMTP_SSL(email_config['smtp_server'], smtp_port)
-                self.logger.info("使用SSL连接")
-            else:
-                # STARTTLS连接
-                server = smtplib.SMTP(email_config['smtp_server'], smtp_port)
-                server.starttls()
-                self.logger.info("使用STARTTLS连接")
+    def _queue_digest(self):
+        """把摘要模式下记录的事件按收件人分组，每组合并成一封汇总邮件加入发送队列
+
+        账号可以单独设置email_alerts，各账号的事件只发给该账号配置的收件人。
+        """
+        with self._digest_lock:
+            events, self.digest_events[:] = list(self.digest_events), []
             
-            self.logger.info("开始登录SMTP服务器")
-            server.login(email_config['smtp_user'], email_config['smtp_password'])
-            self.logger.info("SMTP登录成功")
+        groups = {}
+        for event in events:
+            email_config = event['email_config']
+            key = tuple(email_config.get(field) for field in ('smtp_server', 'smtp_port', 'smtp_user', 'from_email', 'to_email'))
+            groups.setdefault(key, []).append(event)
+        for group in groups.values():
+            self._queue_digest_email(group[0]['email_config'], group)
             
-            text = msg.as_string()
-            server.sendmail(email_config['from_email'], [email_config['to_email']], text)
-            server.quit()
+    def _queue_digest_email(self, email_config, events):
+        """把同一收件人的摘要事件合并成一封汇总邮件"""
+        counts = {}
+        for event in events:
+            counts[event['type']] = counts.get(event['type'], 0) + 1
             
-            self.logger.info(f"邮件发送成功: {subject}")
+        type_names = {"success": "成功", "error": "失败", "info": "通知"}
+        summary = ", ".join(f"{type_names.get(alert_type, alert_type)} {count}" for alert_type, count in counts.items())
+        sections = [
+            f"[{event['time']}] {event['account']} - {event['subject']} ({event['type']})\n{event['body'].strip()}"
+            for event in events
+        ]
+        body = f"本次运行共 {len(events)} 条事件: {summary}\n\n" + "\n\n".join(sections)
+        
+        alert_type = "error" if counts.get("error") else "digest"
+        subject = f"签到汇总 ({summary})"
+        accounts = list(dict.fromkeys(event['account'] for event in events))
+        
+        self.logger.info(f"汇总邮件加入发送队列: {len(events)} 条事件, 收件人: {email_config['to_email']}")
+        msg = self._build_email(email_config, subject, body, alert_type, accounts[0] if len(accounts) == 1 else ", ".join(accounts))
+        self.notifier.submit(self._deliver_email, email_config, msg, subject, self.logger, self.trace_span)
             
+    def flush_notifications(self):
+        """退出前发送摘要邮件并等待通知队列发送完毕，最多等待flush_timeout秒
+
+        等待时间不超过运行剩余时间，但至少有flush_grace秒，超过截止时间的失败通知也能发出。
+        """
+        try:
+            self._queue_digest()
         except Exception as e:
-            self.logger.error(f"发送邮件失败: {e}")
-            import traceback
-            self.logger.error(f"详细错误: {traceback.format_exc()}")
+            self.logger.error(f"创建汇总邮件失败: {e}")
             
-    def load_status(self):
-        """加载运行状态"""
-        if self.status_file.exists():
-            try:
-                with open(self.status_file, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-            except:
-                return {}
-        return {}
-        
-    def save_status(self, status_data):
-        """保存运行状态"""
+        if self.notifier.pending:
+            email_config = self.config['email_alerts']
+            timeout = self.run_deadline.cap(email_config.get('flush_timeout', 60), email_config.get('flush_grace', 10))
+            self.logger.info(f"等待 {self.notifier.pending} 封邮件发送完成 (最多 {timeout} 秒)")
+            if not self.notifier.flush(timeout):
+                self.logger.error(f"邮件发送超时，放弃 {self.notifier.pending} 封未发送的邮件")
+                return False
+                
+        # 队列已空，后台线程空闲，可以安全关闭SMTP连接
+        for transport in self._smtp_transports.values():
+            transport.close()
+        return True
+        
+    @property
+    def metrics_enabled(self):
+        metrics_config = self.config['metrics']
+        return bool(metrics_config.get('textfile') or metrics_config.get('port'))
+        
+    def observe_checkin(self, run, success):
+        """把一个账号的签到结果和积分计入指标"""
+        account = self.status_account
+        result = "skipped" if run.finished else ("success" if success else "failure")
+        self.metrics.inc("pve_checkin_checkins", account=account, result=result)
+        if success:
+            self.metrics.set("pve_checkin_last_success_timestamp_seconds", time.time(), account=account)
+        if run.earned is not None:
+            self.metrics.set("pve_checkin_credits_earned", run.earned, account=account)
+        if self.metrics_enabled:
+            balance = self.status_store.last_balance(account)
+            if balance:
+                self.metrics.set("pve_checkin_credits_balance", BalanceTracker.total(balance), account=account)
+                
+    def observe_run(self, run_span):
+        self.metrics.set("pve_checkin_run_duration_seconds", round(run_span["duration_ms"] / 1000, 6))
+        self.metrics.set("pve_checkin_last_run_timestamp_seconds", time.time())
+        
+    def refresh_live_metrics(self):
+        """更新导出时才取值的仪表: 通知队列深度、熔断器状态和当前并发上限"""
+        self.metrics.set("pve_checkin_notification_queue_depth", self.notifier.pending)
+        self.metrics.set("pve_checkin_circuit_open", int(self.circuit_breaker.state != CircuitBreaker.CLOSED))
+        if self.rate_limiter.concurrency_limit is not None:
+            self.metrics.set("pve_checkin_concurrency_limit", self.rate_limiter.concurrency_limit)
+            
+    def export_metrics(self):
+        """把本次运行的指标合并到状态库中的累计值，并原子写入textfile采集器的.prom文件"""
+        if not self.metrics_enabled:
+            return
+        self.refresh_live_metrics()
+        try:
+            self.metrics.load(self.status_store.merge_metrics(*self.metrics.take_pending()))
+            textfile = self.config['metrics'].get('textfile')
+            if textfile:
+                # node_exporter通常以其他用户运行，新建的.prom文件需要可读
+                atomic_write_text(textfile, self.metrics.render(), default_mode=0o644)
+        except Exception as e:
+            self.logger.error(f"导出指标失败: {e}")
+            
+    def start_metrics_server(self):
+        """守护进程模式下在本地端口提供/metrics，按Accept头返回Prometheus文本或OpenMetrics格式"""
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        
+        cron = self
+        
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                openmetrics = 'application/openmetrics-text' in self.headers.get('Accept', '')
+                cron.refresh_live_metrics()
+                body = cron.metrics.render(openmetrics).encode('utf-8')
+                self.send_response(200)
+                if openmetrics:
+                    self.send_header('Content-Type', 'application/openmetrics-text; version=1.0.0; charset=utf-8')
+                else:
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                
+            def log_message(self, format, *args):
+                pass
+                
+        metrics_config = self.config['metrics']
+        server = ThreadingHTTPServer((metrics_config.get('bind', '127.0.0.1'), int(metrics_config['port'])), MetricsHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+        self.logger.info(f"指标服务已启动: http://{server.server_address[0]}:{server.server_address[1]}/metrics")
+        return server
+        
+    def export_trace(self):
+        """把已结束的span追加写入trace文件(每行一个JSON)，未启用--trace时只清空"""
+        spans = self.tracer.drain()
+        if not self.trace_file or not spans:
+            return
+        try:
+            with open(self.trace_file, 'a', encoding='utf-8') as f:
+                for span in spans:
+                    f.write(json.dumps(span, ensure_ascii=False) + "\n")
+        except OSError as e:
+            self.logger.error(f"写入trace文件失败: {e}")
+            
+    def open_status_store(self):
+        """打开状态存储，首次使用时导入旧版JSON状态文件"""
+        status_config = self.config['status']
+        store = StatusStore(
+            self.status_file,
+            retention_days=status_config.get('retention_days', 90),
+            compact_interval_days=status_config.get('compact_interval_days', 7)
+        )
+        
+        legacy_file = self.status_file.with_suffix('.json')
         try:
-            with open(self.status_file, 'w', encoding='utf-8') as f:
-                json.dump(status_data, f, indent=2, ensure_ascii=False)
+            imported = store.import_legacy_json(legacy_file)
+            if imported:
+                self.logger.info(f"已导入旧版状态文件 {legacy_file.name}: {imported} 条记录")
         except Exception as e:
-            self.logger.error(f"保存状态失败: {e}")
+            self.logger.error(f"状态存储维护失败: {e}")
             
+        return store
+        
+    def compact_status_store(self):
+        """按保留天数定期清理过期状态记录 - 启动时和守护进程每次定时签到后调用"""
+        try:
+            deleted = self.status_store.compact_if_due()
+            if deleted:
+                self.logger.info(f"已清理 {deleted} 条过期状态记录")
+        except Exception as e:
+            self.logger.error(f"状态存储维护失败: {e}")
+        
+    @property
+    def status_account(self):
+        """状态记录中的账号名 - 单账号模式下为default"""
+        return self.account_name or StatusStore.DEFAULT_ACCOUNT
+        
+    def new_retry_policy(self, extra_budget=0):
+        """按配置创建重试策略，时间预算从创建时开始计算(extra_budget为分散窗口的长度)"""
+        return RetryPolicy(
+            max_retries=self.config.get('max_retries', 3),
+            base_delay=self.config['retry'].get('base_delay', 10),
+            max_delay=self.config.get('retry_delay', 300),
+            budget=self.config['retry'].get('budget', 900) + extra_budget
+        )
+        
     def run_checkin(self):
-        """运行签到任务"""
+        """运行签到任务 - 可重试的失败按退避策略重试"""
+        self.retry_policy = self.new_retry_policy()
+        self.run_deadline = Deadline(self.config['timeouts'].get('run', 0))
+        self.deadline = Deadline(self.config['timeouts'].get('account', 0), parent=self.run_deadline)
+        self.tracer.new_trace()
+        
+        with self.tracer.span("run", mode="single", host=socket.gethostname()) as run_span:
+            with self.tracer.span("account", parent=run_span, account=self.status_account) as span:
+                self.trace_span = span
+                run = self.start_checkin()
+                while not run.finished:
+                    self.attempt_checkin(run)
+                    if run.retry_delay is None:
+                        break
+                    time.sleep(run.retry_delay)
+                    
+                success = self.finish_checkin(run)
+                span.update(success=success, attempts=run.attempts)
+                self.observe_checkin(run, success)
+            self.trace_span = run_span
+        self.observe_run(run_span)
+        return success
+        
+    def start_checkin(self):
+        """签到前的准备 - 检查今日状态并确定签到前积分"""
         self.logger.info("=" * 60)
         self.logger.info("开始PVE自动签到任务")
         self.logger.info("=" * 60)
         
-        today = datetime.now().strftime("%Y-%m-%d")
-        status = self.load_status()
+        run = CheckinRun(self.checkin_day or datetime.now().strftime("%Y-%m-%d"))
+        previous = self.status_store.get(self.status_account, run.today)
         
         # 检查今天是否已经成功签到
-        if today in status and status[today].get("success", False):
+        if previous and previous.get("success", False):
             self.logger.info("今日已成功签到，检查是否需要发送成功邮件")
             
             # 如果启用了成功邮件通知，仍然发送邮件
             if self.config['email_alerts'].get('on_success', False):
                 self.logger.info("发送今日已签到的成功邮件")
                 
-                # 获取积分信息
-                balance = self.get_credits_balance()
-                balance_info = ""
-                if balance and 'balance' in balance:
-                    balance_data = balance['balance']
-                    available = balance_data.get('available', 0)
-                    used = balance_data.get('used', 0)
-                    total = available + used
-                    balance_info = f"\n积分信息:\n  总积分: {total}\n  可用积分: {available}\n  已使用: {used}"
+                # 积分信息直接使用签到时记录的余额
+                balance_data = previous.get('balance') or self.fetch_balance_data()
+                balance_info = format_balance_info(balance_data)
                 
                 success_msg = f"今日签到状态: 已完成{balance_info}"
                 self._send_email_alert(
@@ -422,47 +2873,81 @@ PVE签到工具状态通知
                 self.logger.info("成功邮件已禁用，跳过邮件发送")
             
             self.logger.info("任务完成")
-            return True
+            run.finished = True
+            run.success = True
+            return run
             
-        # 获取签到前积分
-        before_balance = self.get_credits_balance()
-        before_credits = 0
-        if before_balance:
-            before_credits = before_balance.get('balance', {}).get('available', 0)
+        # 签到前积分使用上次记录的余额，只有首次运行时才需要查询；
+        # 查询与token验证互不依赖，在后台进行，签到请求发出前取回
+        baseline = self.status_store.last_balance(self.status_account)
+        if baseline is None:
+            baseline = self.rollover_baselines.get(self.status_account)
+        run.tracker = BalanceTracker(baseline)
+        if run.tracker.baseline is None:
+            self.pending_baseline = (run.tracker, Prefetch(self.prefetch_baseline))
             
-        # 执行签到
-        success, result = self.perform_checkin()
+        return run
+        
+    def attempt_checkin(self, run):
+        """执行一次签到，失败可重试时设置run.retry_delay"""
+        run.success, run.result = self.perform_checkin()
+        run.attempts += 1
+        run.retry_delay = None
         
-        # 记录结果到状态文件
-        if today not in status:
-            status[today] = {}
+        if run.success:
+            return
+        if isinstance(self.last_failure, CircuitOpenError):
+            # 熔断器打开: defer模式下推迟到探测恢复之后重试，fail模式下直接失败
+            if self.config['circuit_breaker'].get('on_open', 'defer') != 'defer':
+                return
+            minimum = self.last_failure.retry_in
+        elif not self.retry_policy.is_retryable(self.last_failure):
+            return
+        else:
+            minimum = self.last_retry_after
+            
+        run.retry_delay = self.retry_policy.next_delay(run.attempts - 1, minimum)
+        remaining = self.deadline.remaining()
+        if run.retry_delay is not None and remaining is not None and run.retry_delay >= remaining:
+            run.retry_delay = None
+            self.logger.error(f"签到失败 {run.attempts} 次，截止时间前无法完成重试")
+        elif run.retry_delay is None:
+            self.logger.error(f"签到失败 {run.attempts} 次，重试次数或时间预算已用完")
+        else:
+            self.logger.warning(f"签到失败(可重试: {self.last_failure})，{run.retry_delay:.1f} 秒后第 {run.attempts} 次重试")
+            
+    def finish_checkin(self, run):
+        """记录签到结果并发送通知"""
+        if run.finished:
+            return run.success
             
-        status[today].update({
+        today, tracker = run.today, run.tracker
+        success, result = run.success, run.result
+        
+        # 记录结果到状态存储
+        entry = {
             "success": success,
             "timestamp": datetime.now().isoformat(),
             "result": result
-        })
+        }
         
         if success:
-            # 获取签到后积分
-            after_balance = self.get_credits_balance()
-            after_credits = before_credits
-            earned = 0
-            
-            if after_balance:
-                after_credits = after_balance.get('balance', {}).get('available', 0)
-                earned = after_credits - before_credits
-                
-            if earned > 0:
-                # 获取积分详细信息
-                balance_info = ""
-                if after_balance and 'balance' in after_balance:
-                    balance_data = after_balance['balance']
-                    available = balance_data.get('available', 0)
-                    used = balance_data.get('used', 0)
-                    total = available + used
-                    balance_info = f"\n积分信息:\n  总积分: {total}\n  可用积分: {available}\n  已使用: {used}"
+            # 签到后只查询一次积分
+            tracker.after = self.fetch_balance_data()
+            earned = run.earned = tracker.earned(result)
+            before_credits, after_credits = tracker.credits_change(earned)
+            balance_info = format_balance_info(tracker.after)
+            if tracker.after:
+                entry["balance"] = tracker.after
                 
+            if earned is None:
+                # 签到前余额未知(如token失效导致查询失败)，只报告当前积分
+                success_msg = f"签到成功! 当前可用积分: {after_credits}{format_balance_info(tracker.after)}"
+                self.logger.info(success_msg)
+                
+                if self.config['email_alerts'].get('on_success', False):
+                    self._send_email_alert("签到成功", success_msg, "success")
+            elif earned > 0:
                 success_msg = f"签到成功! 获得 {earned} 积分，总积分: {before_credits} -> {after_credits}{balance_info}"
                 self.logger.info(success_msg)
                 
@@ -474,15 +2959,6 @@ PVE签到工具状态通知
                         "success"
                     )
             else:
-                # 获取积分详细信息
-                balance_info = ""
-                if after_balance and 'balance' in after_balance:
-                    balance_data = after_balance['balance']
-                    available = balance_data.get('available', 0)
-                    used = balance_data.get('used', 0)
-                    total = available + used
-                    balance_info = f"\n积分信息:\n  总积分: {total}\n  可用积分: {available}\n  已使用: {used}"
-                
                 self.logger.info("签到完成 (今日已签到)")
                 
                 # 发送成功邮件（如果启用）
@@ -504,17 +2980,13 @@ PVE签到工具状态通知
                         # 这种情况视为签到成功
                         self.logger.info(f"今日已签到: {message}")
                         # 更新状态为成功
-                        status[today].update({"success": True})
+                        entry["success"] = True
                         
-                        # 获取积分信息用于成功邮件
-                        after_balance = self.get_credits_balance()
-                        balance_info = ""
-                        if after_balance and 'balance' in after_balance:
-                            balance_data = after_balance['balance']
-                            available = balance_data.get('available', 0)
-                            used = balance_data.get('used', 0)
-                            total = available + used
-                            balance_info = f"\n积分信息:\n  总积分: {total}\n  可用积分: {available}\n  已使用: {used}"
+                        # 获取积分信息用于成功邮件，并记录为下次的基准余额
+                        balance_data = self.fetch_balance_data()
+                        balance_info = format_balance_info(balance_data)
+                        if balance_data:
+                            entry["balance"] = balance_data
                         
                         # 发送成功邮件（根据配置）
                         if self.config['email_alerts'].get('on_success', False):
@@ -525,7 +2997,7 @@ PVE签到工具状态通知
                                 "success"
                             )
                         
-                        self.save_status(status)
+                        self.status_store.record(self.status_account, today, entry)
                         return True
                     else:
                         error_msg = f"签到失败: {message}"
@@ -539,8 +3011,13 @@ PVE签到工具状态通知
                 
             self.logger.error(error_msg)
             
+            # 服务中断期间的失败已由一封服务中断通知汇报
+            outage = self.circuit_breaker.state != CircuitBreaker.CLOSED or isinstance(self.last_failure, CircuitOpenError)
+            if outage:
+                self.logger.info("服务中断期间签到失败，不单独发送失败邮件")
+                
             # 发送失败邮件
-            if self.config['email_alerts'].get('on_failure', True):
+            if self.config['email_alerts'].get('on_failure', True) and not outage:
                 self._send_email_alert(
                     "签到失败",
                     f"{error_msg}\n\n{detailed_error}\n\n请检查网络连接和配置是否正确。",
@@ -548,23 +3025,156 @@ PVE签到工具状态通知
                 )
                 
         # 保存状态
-        self.save_status(status)
+        self.status_store.record(self.status_account, today, entry)
         
         return success
     
+    def enabled_accounts(self):
+        accounts = [account for account in self.config.get('accounts', []) if account.get('enabled', True)]
+        if self.shard:
+            accounts = [account for account in accounts if self.account_shard(account) == self.shard[0]]
+        return accounts
+        
+    def account_key(self, account):
+        """分片和分散调度使用的账号标识 - 登录邮箱，同一个登录账号即使配置了多次也相同"""
+        return account.get('login', {}).get('email') or self.account_label(account)
+        
+    def account_shard(self, account):
+        """账号所属的分片"""
+        return shard_owner(self.account_key(account), self.shard[1])
+        
+    def spread_window(self):
+        """批量签到的分散窗口秒数 - 不超过当天剩余时间和运行截止时间，并各留出重试时间预算"""
+        window = self.config['schedule'].get('spread_window', 0)
+        if not window:
+            return 0
+        reserve = self.config['retry'].get('budget', 900)
+        now = datetime.now()
+        until_midnight = (datetime.combine(now.date() + timedelta(days=1), datetime.min.time()) - now).total_seconds()
+        window = min(window, until_midnight - reserve)
+        remaining = self.run_deadline.remaining()
+        if remaining is not None:
+            window = min(window, remaining - reserve)
+        return max(0, window)
+        
+    def spread_offsets(self, accounts, window, prioritize=True):
+        """各账号在分散窗口内的开始偏移秒数 {账号名: 秒}
+
+        偏移按账号标识哈希固定分布在窗口内，再加jitter秒以内的随机抖动。prioritize时上次
+        签到失败的账号和今天已经签到成功(无需请求)的账号偏移为0，排在窗口最前面。
+        """
+        schedule = self.config['schedule']
+        jitter = schedule.get('jitter', 0)
+        today = self.checkin_day or datetime.now().strftime("%Y-%m-%d")
+        offsets = {}
+        for account in accounts:
+            name = self.account_label(account)
+            latest = self.status_store.latest(name) if prioritize else None
+            if latest and (latest == (today, True) or (not latest[1] and schedule.get('failed_first', True))):
+                offsets[name] = 0
+                continue
+            offset = spread_offset(self.account_key(account), window)
+            offsets[name] = min(window, offset + random.uniform(0, jitter)) if jitter else offset
+        return offsets
+        
+    def run_batch(self, accounts=None, spread=True):
+        """批量签到 - 并发执行accounts列表中的所有账号(或指定的部分账号)
+
+        配置了schedule.spread_window时各账号在窗口内错开开始(守护进程已按偏移调度，传入spread=False)。
+        """
+        if accounts is None:
+            accounts = self.enabled_accounts()
+        concurrency = max(1, int(self.config.get('batch', {}).get('concurrency', 10)))
+        
+        self.logger.info("=" * 60)
+        self.logger.info(f"开始批量签到任务: {len(accounts)} 个账号, 并发数: {concurrency}")
+        self.logger.info("=" * 60)
+        
+        if not accounts:
+            if self.shard:
+                self.logger.info(f"分片 {self.shard[0]}/{self.shard[1]} 没有需要签到的账号")
+                return True
+            self.logger.warning("accounts列表为空，没有需要签到的账号")
+            return False
+            
+        # 所有账号共享同一个重试时间预算和运行截止时间；分散签到时预算从窗口结束时算起
+        self.run_deadline = self.deadline = Deadline(self.config['timeouts'].get('run', 0))
+        window = self.spread_window() if spread else 0
+        offsets = {}
+        if window:
+            offsets = self.spread_offsets(accounts, window)
+            accounts = sorted(accounts, key=lambda account: offsets[self.account_label(account)])
+            front = sum(1 for offset in offsets.values() if offset == 0)
+            self.logger.info(f"分散签到: {len(accounts)} 个账号分布在 {window:.0f} 秒内，{front} 个账号(上次失败或今日已完成)优先")
+        self.retry_policy = self.new_retry_policy(extra_budget=window)
+        self.tracer.new_trace()
+            
+        import asyncio
+        with self.tracer.span("run", mode="batch", host=socket.gethostname(), accounts=len(accounts)) as run_span:
+            # 账号的span以运行span为父节点，汇总邮件也挂在运行span下
+            self.trace_span = run_span
+            results = asyncio.run(self._run_batch_async(accounts, concurrency, offsets))
+        self.observe_run(run_span)
+        
+        failed = [name for name, success in results if not success]
+        self.logger.info(f"批量签到完成: 成功 {len(results) - len(failed)}, 失败 {len(failed)}")
+        if failed:
+            self.logger.error(f"签到失败的账号: {', '.join(failed)}")
+            
+        return not failed
+        
+    async def _run_batch_async(self, accounts, concurrency, offsets=None):
+        """在线程池中并发运行各账号的签到流程，总耗时取决于最慢的账号
+
+        offsets为各账号开始前等待的秒数，等待期间不占用并发名额。
+        """
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+        
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(concurrency)
+        
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="checkin") as executor:
+            async def run_account(account):
+                worker = self.account_view(account)
+                delay = (offsets or {}).get(worker.account_name, 0)
+                if delay:
+                    await asyncio.sleep(delay)
+                async with semaphore:
+                    # 账号的截止时间从开始签到时计算，排队等待的时间不计入
+                    worker.deadline = Deadline(self.config['timeouts'].get('account', 0), parent=self.run_deadline)
+                    with self.tracer.span("account", parent=self.trace_span, account=worker.account_name) as span:
+                        worker.trace_span = span
+                        run = None
+                        try:
+                            run = await loop.run_in_executor(executor, worker.start_checkin)
+                            while not run.finished:
+                                await loop.run_in_executor(executor, worker.attempt_checkin, run)
+                                if run.retry_delay is None:
+                                    break
+                                # 等待重试期间让出并发名额，其他账号的签到继续执行
+                                semaphore.release()
+                                try:
+                                    await asyncio.sleep(run.retry_delay)
+                                finally:
+                                    await semaphore.acquire()
+                            success = await loop.run_in_executor(executor, worker.finish_checkin, run)
+                            worker.observe_checkin(run, success)
+                        except Exception as e:
+                            worker.logger.error(f"账号签到出错: {e}")
+                            span["error"] = f"{type(e).__name__}: {e}"
+                            success = False
+                        span.update(success=success, attempts=run.attempts if run else 0)
+                return worker.account_name, success
+                
+            return await asyncio.gather(*(run_account(account) for account in accounts))
+    
     def test_email(self):
         """测试邮件发送功能"""
         self.logger.info("开始测试邮件发送功能")
         
         # 获取积分信息用于测试
-        balance = self.get_credits_balance()
-        balance_info = ""
-        if balance and 'balance' in balance:
-            balance_data = balance['balance']
-            available = balance_data.get('available', 0)
-            used = balance_data.get('used', 0)
-            total = available + used
-            balance_info = f"\n积分信息:\n  总积分: {total}\n  可用积分: {available}\n  已使用: {used}"
+        balance_info = format_balance_info(self.fetch_balance_data())
         
         test_msg = f"这是一封测试邮件，用于验证PVE签到工具的邮件功能是否正常。{balance_info}\n\n如果收到此邮件，说明邮件配置正确。"
         
@@ -574,8 +3184,222 @@ PVE签到工具状态通知
             "test"
         )
         
+        # 测试模式需要等待发送结果
+        success = self.flush_notifications() and self.notifier.failed == 0
         self.logger.info("邮件测试完成，请检查收件箱")
+        return success
+        
+    def now(self):
+        """判断token是否过期所用的当前时间戳"""
+        return time.time() + self.clock_offset
+        
+    def use_cassette(self, cassette):
+        """之后的HTTP请求和SMTP发送都经过录制文件 - 录制时仍访问真实服务器，回放时不访问网络
+
+        回放时token过期判断按录制时的时间进行，录制时的token在回放时不会因为时间流逝走到不同的分支。
+        """
+        self.cassette = cassette
+        self.session = CassetteSession(cassette, None if cassette.replay else self.session)
+        self._smtp_transports = {}
+        if cassette.replay:
+            self.clock_offset = cassette.started_at - time.time()
+        
+    def estimate_clock_skew(self, samples=8):
+        """请求/api/auth/user若干次，按响应的Date头估计服务器时钟偏差，返回ClockSkew
+
+        401响应同样带有Date头，因此不需要有效的token。请求间隔为1/samples秒多一点，
+        使样本落在一秒内的不同位置。
+        """
+        skew = ClockSkew()
+        spacing = 1.0 / max(1, samples) + 0.01
+        for index in range(max(1, samples)):
+            if index:
+                time.sleep(spacing)
+            try:
+                sent = time.time()
+                response = self._api_request('GET', "/api/auth/user", headers=self.get_auth_headers())
+                received = time.time()
+            except Exception as e:
+                self.logger.warning(f"时钟偏差采样失败: {e}")
+                continue
+            skew.add(sent, received, response.headers.get('Date'))
+        return skew
+        
+    def prewarm(self):
+        """零点签到前的预热 - 各账号验证token(失效时重新登录)，建立到服务器的连接，
+        并查询没有历史记录的账号的签到前余额，零点后只需要发出签到请求
+        """
+        def warm(worker):
+            # JWT快过期时提前重新登录，非JWT的token由服务器验证
+            if worker.ensure_valid_token():
+                self.prewarmed_tokens.add(worker.config.get('auth_token'))
+            if self.status_store.last_balance(worker.status_account) is None:
+                balance = worker.fetch_balance_data()
+                if balance is not None:
+                    self.rollover_baselines[worker.status_account] = balance
+                    
+        if not self.config.get('accounts'):
+            warm(self)
+            return
+            
+        from concurrent.futures import ThreadPoolExecutor
+        concurrency = max(1, int(self.config.get('batch', {}).get('concurrency', 10)))
+        workers = [self.account_view(account) for account in self.enabled_accounts()]
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="prewarm") as executor:
+            list(executor.map(warm, workers))
+            
+    def run_rollover(self):
+        """零点签到 - 估计服务器时钟偏差，零点前预热连接和token，在服务器北京时间零点后
+        fire_delay_ms毫秒(加上偏差估计的误差)发出签到请求
+
+        应在零点前几分钟启动；启动时刚过零点(一分钟内)则立即签到。
+        """
+        rollover = self.config['rollover']
+        skew = self.estimate_clock_skew(rollover.get('skew_samples', 8))
+        if not skew.samples:
+            self.logger.error("无法从服务器响应的Date头估计时钟偏差，放弃零点签到")
+            return False
+        self.logger.info(
+            f"服务器时钟比本机{'快' if skew.offset >= 0 else '慢'} {abs(skew.offset) * 1000:.0f}ms "
+            f"(误差 ±{skew.error * 1000:.0f}ms, {skew.samples} 个样本)"
+        )
+        if skew.conflicts:
+            self.logger.warning(f"时钟偏差样本中有 {skew.conflicts} 个互相矛盾，估计可能不准确")
+            
+        server_now = datetime.fromtimestamp(time.time() + skew.offset, BEIJING_TZ)
+        midnight = server_now.replace(hour=0, minute=0, second=0, microsecond=0)
+        if (server_now - midnight).total_seconds() >= 60:
+            midnight += timedelta(days=1)
+        # 偏差估计有误差，加上误差保证签到请求到达时服务器已过零点
+        fire_at = midnight.timestamp() - skew.offset + skew.error + rollover.get('fire_delay_ms', 200) / 1000
+        
+        wait = fire_at - time.time()
+        if wait > rollover.get('max_wait', 3600):
+            self.logger.error(f"距离服务器零点还有 {wait / 60:.0f} 分钟，超过rollover.max_wait，请在零点前几分钟启动")
+            return False
+        # 签到状态按服务器的签到日期记录，本机时区不是北京时间时也与服务器一致
+        self.checkin_day = midnight.strftime("%Y-%m-%d")
+        self.logger.info(f"将在本机时间 {datetime.fromtimestamp(fire_at).strftime('%H:%M:%S.%f')[:-3]} 签到 (等待 {max(0, wait):.1f} 秒)")
+        
+        sleep_until(fire_at - rollover.get('prewarm_seconds', 15))
+        if time.time() < fire_at:
+            self.logger.info("预热连接和token")
+            self.prewarm()
+        sleep_until(fire_at)
+        
+        self.logger.info("服务器已过零点，开始签到")
+        if self.config.get('accounts'):
+            return self.run_batch(spread=False)
+        return self.run_checkin()
+        
+    def run_daemon(self):
+        """守护进程模式 - 常驻运行，按每日签到时间触发，token、连接和状态存储在两次签到之间保持"""
+        self._stop_event = threading.Event()
+        self._reload_requested = False
+        
+        signal.signal(signal.SIGTERM, self._handle_stop_signal)
+        signal.signal(signal.SIGINT, self._handle_stop_signal)
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, self._handle_reload_signal)
+            
+        if self.config['metrics'].get('port'):
+            try:
+                self.start_metrics_server()
+            except OSError as e:
+                self.logger.error(f"指标服务启动失败: {e}")
+                
+        wheel = self._build_timer_wheel()
+        now = datetime.now()
+        wheel.advance(now)
+        
+        # 启动时补签当天已过签到时间但尚未成功的账号
+        pending = []
+        if self.config['daemon'].get('catch_up', True):
+            pending = self._unfinished_jobs(wheel.jobs_before(TimerWheel.second_of_day(now)))
+            
+        self.logger.info(f"守护进程已启动 (PID {os.getpid()})，共 {sum(len(jobs) for jobs in wheel.slots.values())} 个签到任务")
+        
+        while not self._stop_event.is_set():
+            if self._reload_requested:
+                self._reload_requested = False
+                self.logger.info("收到SIGHUP，重新加载配置")
+                self.reload_config()
+                cursor, day = wheel.cursor, wheel.day
+                wheel = self._build_timer_wheel()
+                wheel.cursor, wheel.day = cursor, day
+                
+            due = pending + wheel.advance(datetime.now())
+            pending = []
+            if due:
+                self._run_scheduled(due)
+                
+            # 等到下一个整秒
+            self._stop_event.wait(1 - datetime.now().microsecond / 1e6)
+            
+        self.logger.info("守护进程退出")
+        self.flush_notifications()
+        self.export_trace()
+        self.export_metrics()
         return True
+        
+    def _handle_stop_signal(self, signum, frame):
+        self.logger.info(f"收到信号 {signum}，当前任务完成后退出")
+        self._stop_event.set()
+        
+    def _handle_reload_signal(self, signum, frame):
+        self._reload_requested = True
+        
+    def _build_timer_wheel(self):
+        """按配置的签到时间(HH:MM或HH:MM:SS，账号可单独配置checkin_time)建立定时轮"""
+        wheel = TimerWheel()
+        default_time = self.config['daemon'].get('checkin_time', '09:00')
+        
+        offsets = {}
+        if self.config.get('accounts'):
+            accounts = self.enabled_accounts()
+            jobs = [(account.get('checkin_time', default_time), self.account_label(account)) for account in accounts]
+            window = self.config['schedule'].get('spread_window', 0)
+            if window:
+                # 定时轮每天复用，只使用固定偏移；之前失败的账号由启动时的补签处理
+                offsets = self.spread_offsets(accounts, window, prioritize=False)
+        else:
+            jobs = [(default_time, None)]
+            
+        # 分散签到的偏移加在各账号的签到时间上，最晚不超过当天结束前留出的重试时间预算
+        latest = TimerWheel.SLOTS - 1 - self.config['retry'].get('budget', 900)
+        for checkin_time, name in jobs:
+            parts = [int(part) for part in checkin_time.split(':')] + [0]
+            second = parts[0] * 3600 + parts[1] * 60 + parts[2]
+            if offsets.get(name):
+                second = max(second, min(second + int(offsets[name]), latest))
+            wheel.schedule(second, name)
+        return wheel
+        
+    def _unfinished_jobs(self, jobs):
+        """过滤出今天还没有成功签到的任务"""
+        today = datetime.now().strftime("%Y-%m-%d")
+        unfinished = []
+        for name in jobs:
+            entry = self.status_store.get(name or StatusStore.DEFAULT_ACCOUNT, today)
+            if not (entry and entry.get('success')):
+                unfinished.append(name)
+        return unfinished
+        
+    def _run_scheduled(self, jobs):
+        """执行到期的签到任务，完成后发送队列中的邮件"""
+        try:
+            if self.config.get('accounts'):
+                names = set(jobs)
+                accounts = [account for account in self.enabled_accounts() if self.account_label(account) in names]
+                self.run_batch(accounts, spread=False)
+            else:
+                self.run_checkin()
+        except Exception as e:
+            self.logger.error(f"定时签到出错: {e}")
+        self.compact_status_store()
+        self.flush_notifications()
+        self.export_trace()
+        self.export_metrics()
 
 def main():
     """主函数 - 适合crontab调用"""
@@ -583,25 +3407,115 @@ def main():
     config_path = None
     test_mode = False
     test_email = False
+    daemon_mode = False
+    profile_mode = False
+    merge_mode = False
+    rollover_mode = False
+    trace_path = None
+    record_path = None
+    replay_path = None
+    replay_timing = "original"
+    shard = None
     
     for i, arg in enumerate(sys.argv[1:], 1):
         if arg == '--test':
             test_mode = True
+        elif arg == '--trace':
+            trace_path = ''
+        elif arg.startswith('--trace='):
+            trace_path = arg.split('=', 1)[1]
+        elif arg == '--daemon':
+            daemon_mode = True
+        elif arg == '--profile-startup':
+            profile_mode = True
         elif arg == '--test-email':
             test_email = True
+        elif arg == '--merge-shards':
+            merge_mode = True
+        elif arg == '--rollover':
+            rollover_mode = True
+        elif arg.startswith('--record='):
+            record_path = arg.split('=', 1)[1]
+        elif arg.startswith('--replay='):
+            replay_path = arg.split('=', 1)[1]
+        elif arg.startswith('--replay-timing='):
+            replay_timing = arg.split('=', 1)[1]
+        elif arg == '--shard' and i + 1 < len(sys.argv):
+            shard = sys.argv[i + 1]
+        elif arg.startswith('--shard='):
+            shard = arg.split('=', 1)[1]
         elif arg == '--config' and i + 1 < len(sys.argv):
             config_path = sys.argv[i + 1]
         elif arg.startswith('--config='):
             config_path = arg.split('=', 1)[1]
     
+    # 启动耗时分析不执行签到
+    if profile_mode:
+        sys.exit(profile_startup(config_path))
+        
+    # 合并各分片的状态库，不执行签到
+    if merge_mode:
+        config_dir = Path(config_path).parent if config_path else Path(__file__).parent.absolute()
+        try:
+            merged = merge_status_segments(config_dir / "pve_checkin_status.db")
+        except sqlite3.Error as e:
+            print(f"合并分片状态失败: {e}")
+            sys.exit(2)
+        for name, checkins, tokens in merged:
+            print(f"{name}: 合并 {checkins} 条签到记录, {tokens} 个token")
+        print(f"已合并 {len(merged)} 个分片到 {config_dir / 'pve_checkin_status.db'}")
+        sys.exit(0)
+        
+    if shard is not None:
+        try:
+            shard = parse_shard(shard)
+        except ValueError as e:
+            print(e)
+            sys.exit(2)
+            
+    # 录制和回放在临时目录中使用配置文件的副本运行，每次都从相同的初始状态(空状态库)开始，
+    # 不修改真实的配置文件和状态库
+    cassette = None
+    log_dir = None
+    if record_path or replay_path:
+        if replay_timing not in ("original", "zero"):
+            print("--replay-timing 只能是 original 或 zero")
+            sys.exit(2)
+        try:
+            cassette = Cassette(replay_path or record_path, replay=bool(replay_path), timing=replay_timing)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"读取录制文件失败: {e}")
+            sys.exit(2)
+        import shutil
+        sandbox = tempfile.TemporaryDirectory(prefix="pve_checkin_cassette_")
+        source = Path(config_path) if config_path else Path(__file__).parent.absolute() / "pve_checkin_config.json"
+        if source.exists():
+            shutil.copy(source, Path(sandbox.name) / source.name)
+        config_path = str(Path(sandbox.name) / source.name)
+        # 日志和追踪文件写入原配置文件所在目录，临时目录在退出时删除
+        log_dir = source.absolute().parent
+        
     try:
         # 创建签到实例
-        checkin = PVECheckinCron(config_path)
+        checkin = PVECheckinCron(config_path, shard=shard, log_dir=log_dir)
+        if cassette is not None:
+            checkin.use_cassette(cassette)
+        started = time.perf_counter()
+        
+        if shard and not checkin.config.get('accounts'):
+            print("--shard 只能用于配置了accounts的批量模式")
+            sys.exit(2)
+        
+        # --trace不带路径时写入配置文件所在目录(录制和回放时为原配置文件所在目录)
+        if trace_path is not None:
+            checkin.trace_file = Path(trace_path) if trace_path else checkin.log_dir / "pve_checkin_trace.jsonl"
         
         if test_mode:
             print("PVE Checkin Tool Test Mode")
             print(f"Config: {checkin.config_file}")
             print(f"Status: {checkin.status_file}")
+            if shard:
+                print(f"Shard: {shard[0]}/{shard[1]} ({len(checkin.enabled_accounts())} accounts)")
             print(f"Log: {checkin.log_file}")
             print("-" * 50)
         
@@ -611,17 +3525,42 @@ def main():
             print("-" * 50)
             # 测试邮件发送
             success = checkin.test_email()
+            checkin.export_trace()
             print(f"Email Test Result: {'Success' if success else 'Failed'}")
             print("请检查收件箱中是否收到测试邮件")
             sys.exit(0 if success else 1)
             
-        # 运行签到
-        success = checkin.run_checkin()
+        # 守护进程模式常驻运行，收到SIGTERM后退出
+        if daemon_mode:
+            sys.exit(0 if checkin.run_daemon() else 1)
+            
+        # 运行签到 - 配置了accounts时使用批量模式
+        if rollover_mode:
+            success = checkin.run_rollover()
+        elif checkin.config.get('accounts'):
+            success = checkin.run_batch()
+        else:
+            success = checkin.run_checkin()
         
         if test_mode:
             print(f"Result: {'Success' if success else 'Failed'}")
             print(f"Log saved to: {checkin.log_file}")
             
+        # 退出前发送完队列中的邮件
+        checkin.flush_notifications()
+        checkin.export_trace()
+        checkin.export_metrics()
+        
+        # 关闭状态库，WAL内容写回数据库文件(分片状态库会被单独上传和合并)
+        checkin.status_store.close()
+        
+        if record_path:
+            cassette.save()
+            print(f"已录制 {len(cassette.interactions)} 个交互到 {record_path}")
+        elif replay_path:
+            print(f"回放 {len(cassette.interactions) - cassette.unused}/{len(cassette.interactions)} 个交互 "
+                  f"({replay_timing}), 耗时 {elapsed_ms(started)}ms")
+            
         # 返回适当的退出码
         sys.exit(0 if success else 1)
         
@@ -0,0 +1,65 @@
+"""对本地模拟服务器(mirror_stub_server.py)运行批量签到的集成测试
+
+运行: python -m pytest -q (或 python -m unittest discover tests)
+"""
+
+import json
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import mirror_stub_server
+import pve_checkin_cron
+from pve_checkin_cron import PVECheckinCron
+
+
+class BatchStubTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server, self.state = mirror_stub_server.start_stub_server(port=0)
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.workdir = tempfile.TemporaryDirectory()
+        pve_checkin_cron.reset_http_session()
+
+    def tearDown(self):
+        pve_checkin_cron.stop_log_listener()
+        pve_checkin_cron.reset_http_session()
+        self.server.shutdown()
+        self.server.server_close()
+        self.workdir.cleanup()
+
+    def make_checkin(self, config):
+        config = dict({"base_url": self.base_url, "email_alerts": {"enabled": False}}, **config)
+        config_file = Path(self.workdir.name) / "pve_checkin_config.json"
+        config_file.write_text(json.dumps(config), encoding='utf-8')
+        return PVECheckinCron(config_file)
+
+    def test_accounts_do_not_inherit_root_token(self):
+        # 全局auth_token属于a，b只配置了自己的login；b不能用a的token签到
+        checkin = self.make_checkin({
+            "auth_token": mirror_stub_server.make_token("a@example.com", 86400),
+            "accounts": [
+                {"name": "a", "login": {"email": "a@example.com", "password": "x"}},
+                {"name": "b", "login": {"email": "b@example.com", "password": "x"}}
+            ]
+        })
+        self.assertTrue(checkin.run_batch(spread=False))
+        self.assertEqual(self.state.signed, {"a@example.com", "b@example.com"})
+        self.assertEqual(self.state.stats()["requests"]["POST /api/checkin"], 2)
+
+    def test_second_run_uses_status_store(self):
+        checkin = self.make_checkin({
+            "accounts": [{"name": "a", "login": {"email": "a@example.com", "password": "x"}}]
+        })
+        self.assertTrue(checkin.run_batch(spread=False))
+        self.state.reset()
+        # 今天已成功签到的账号不再请求签到接口
+        self.assertTrue(checkin.run_batch(spread=False))
+        self.assertNotIn("POST /api/checkin", self.state.stats()["requests"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,197 @@
+"""定时轮、分片、熔断器、时钟偏差估计和配置合并的单元测试
+
+运行: python -m pytest -q (或 python -m unittest discover tests)
+"""
+
+import sys
+import time
+import unittest
+from datetime import datetime
+from email.utils import formatdate
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from pve_checkin_cron import (
+    CircuitBreaker,
+    ClockSkew,
+    TimerWheel,
+    merge_config_changes,
+    shard_owner,
+    update_in_place
+)
+
+
+class TimerWheelTest(unittest.TestCase):
+
+    def make_wheel(self, *seconds):
+        wheel = TimerWheel()
+        for second in seconds:
+            wheel.schedule(second, second)
+        return wheel
+
+    def test_first_advance_only_sets_cursor(self):
+        wheel = self.make_wheel(9 * 3600)
+        self.assertEqual(wheel.advance(datetime(2026, 1, 1, 10, 0, 0)), [])
+        self.assertEqual(wheel.cursor, 10 * 3600)
+
+    def test_fires_jobs_in_passed_slots(self):
+        wheel = self.make_wheel(9 * 3600, 9 * 3600 + 5)
+        wheel.advance(datetime(2026, 1, 1, 8, 59, 59))
+        self.assertEqual(wheel.advance(datetime(2026, 1, 1, 9, 0, 0)), [9 * 3600])
+        self.assertEqual(wheel.advance(datetime(2026, 1, 1, 9, 0, 10)), [9 * 3600 + 5])
+        self.assertEqual(wheel.advance(datetime(2026, 1, 1, 9, 0, 11)), [])
+
+    def test_wraps_past_midnight(self):
+        wheel = self.make_wheel(TimerWheel.SLOTS - 1, 0, 1)
+        wheel.advance(datetime(2026, 1, 1, 23, 59, 58))
+        self.assertEqual(wheel.advance(datetime(2026, 1, 2, 0, 0, 1)), [TimerWheel.SLOTS - 1, 0, 1])
+
+    def test_job_fires_once_per_day(self):
+        wheel = self.make_wheel(9 * 3600)
+        wheel.advance(datetime(2026, 1, 1, 9, 0, 0))
+        self.assertEqual(wheel.advance(datetime(2026, 1, 2, 8, 0, 0)), [])
+        self.assertEqual(wheel.advance(datetime(2026, 1, 2, 9, 0, 0)), [9 * 3600])
+
+    def test_backward_clock_step_does_not_fire(self):
+        wheel = self.make_wheel(9 * 3600 + 30)
+        wheel.advance(datetime(2026, 1, 1, 9, 1, 0))
+        # 时钟回拨到签到时间之前，回拨本身不触发任务
+        self.assertEqual(wheel.advance(datetime(2026, 1, 1, 9, 0, 0)), [])
+        self.assertEqual(wheel.cursor, 9 * 3600)
+        # 再次走到签到时间时照常触发
+        self.assertEqual(wheel.advance(datetime(2026, 1, 1, 9, 0, 30)), [9 * 3600 + 30])
+
+    def test_backward_step_across_midnight_does_not_fire(self):
+        wheel = self.make_wheel(12 * 3600)
+        wheel.advance(datetime(2026, 1, 2, 0, 0, 5))
+        self.assertEqual(wheel.advance(datetime(2026, 1, 1, 23, 59, 50)), [])
+        self.assertEqual(wheel.day, datetime(2026, 1, 1).date())
+
+    def test_jobs_before(self):
+        wheel = self.make_wheel(100, 200, 300)
+        self.assertEqual(wheel.jobs_before(200), [100])
+
+
+class ShardOwnerTest(unittest.TestCase):
+
+    def test_stable_and_in_range(self):
+        for key in ("a@example.com", "b@example.com", "c@example.com"):
+            owner = shard_owner(key, 4)
+            self.assertIn(owner, range(1, 5))
+            self.assertEqual(owner, shard_owner(key, 4))
+
+    def test_adding_a_shard_moves_only_keys_to_the_new_shard(self):
+        keys = [f"user{i}@example.com" for i in range(400)]
+        moved = [key for key in keys if shard_owner(key, 4) != shard_owner(key, 5)]
+        self.assertTrue(all(shard_owner(key, 5) == 5 for key in moved))
+        # 约1/5的账号移动到新分片
+        self.assertLess(len(moved), len(keys) * 0.35)
+
+    def test_single_shard(self):
+        self.assertEqual(shard_owner("a@example.com", 1), 1)
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def test_opens_after_threshold_and_probes_after_timeout(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+        self.assertIsNone(breaker.record(False))
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.record(False), CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow())
+        self.assertGreater(breaker.retry_in(), 0)
+
+        time.sleep(0.06)
+        # 半开状态只放行一个探测请求
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        self.assertEqual(breaker.record(True), CircuitBreaker.CLOSED)
+        self.assertTrue(breaker.allow())
+
+    def test_failed_probe_reopens(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+        breaker.record(False)
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow())
+        self.assertIsNone(breaker.record(False))
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow())
+
+    def test_success_resets_failure_count(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        breaker.record(False)
+        breaker.record(True)
+        self.assertIsNone(breaker.record(False))
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_disabled(self):
+        breaker = CircuitBreaker(failure_threshold=0)
+        for _ in range(10):
+            self.assertIsNone(breaker.record(False))
+        self.assertTrue(breaker.allow())
+
+
+class ClockSkewTest(unittest.TestCase):
+
+    @staticmethod
+    def sample(skew, sent, server_offset, rtt=0.04):
+        """模拟一次请求: 服务器在往返中点生成响应，Date头截断到秒"""
+        server = sent + rtt / 2 + server_offset
+        return skew.add(sent, sent + rtt, formatdate(int(server), usegmt=True))
+
+    def test_samples_narrow_the_estimate(self):
+        skew = ClockSkew()
+        start = 1700000000.0
+        for index in range(8):
+            self.sample(skew, start + index * (1 / 8 + 0.01), 2.3)
+        self.assertEqual(skew.samples, 8)
+        self.assertEqual(skew.conflicts, 0)
+        self.assertLessEqual(abs(skew.offset - 2.3), skew.error)
+        self.assertLess(skew.error, 0.2)
+
+    def test_conflicting_sample_restarts_estimate(self):
+        skew = ClockSkew()
+        start = 1700000000.0
+        self.sample(skew, start, 2.3)
+        self.sample(skew, start + 0.5, -5.0)
+        self.assertEqual(skew.conflicts, 1)
+        self.assertLessEqual(abs(skew.offset + 5.0), skew.error)
+
+    def test_missing_or_invalid_date_header(self):
+        skew = ClockSkew()
+        self.assertFalse(skew.add(0, 1, None))
+        self.assertFalse(skew.add(0, 1, "not a date"))
+        self.assertEqual(skew.samples, 0)
+
+
+class ConfigMergeTest(unittest.TestCase):
+
+    def test_keeps_our_changes_and_their_other_changes(self):
+        base = {"auth_token": "old", "email_alerts": {"enabled": True, "to_email": "a@x"}}
+        ours = {"auth_token": "new", "email_alerts": {"enabled": True, "to_email": "a@x"}}
+        theirs = {"auth_token": "old", "email_alerts": {"enabled": False, "to_email": "a@x"}, "extra": 1}
+        merged = merge_config_changes(base, ours, theirs)
+        self.assertEqual(merged, {"auth_token": "new", "email_alerts": {"enabled": False, "to_email": "a@x"}, "extra": 1})
+
+    def test_merges_account_lists_by_position(self):
+        base = {"accounts": [{"name": "a", "auth_token": ""}, {"name": "b", "auth_token": ""}]}
+        ours = {"accounts": [{"name": "a", "auth_token": "ta"}, {"name": "b", "auth_token": ""}]}
+        theirs = {"accounts": [{"name": "a", "auth_token": ""}, {"name": "b", "auth_token": "tb"}]}
+        merged = merge_config_changes(base, ours, theirs)
+        self.assertEqual([account["auth_token"] for account in merged["accounts"]], ["ta", "tb"])
+
+    def test_conflicting_change_prefers_ours(self):
+        self.assertEqual(merge_config_changes({"x": 1}, {"x": 2}, {"x": 3}), {"x": 2})
+
+    def test_update_in_place_keeps_nested_references(self):
+        account = {"name": "a", "auth_token": "old"}
+        target = {"accounts": [account], "removed": True}
+        update_in_place(target, {"accounts": [{"name": "a", "auth_token": "new"}]})
+        self.assertIs(target["accounts"][0], account)
+        self.assertEqual(account["auth_token"], "new")
+        self.assertNotIn("removed", target)
+
+
+if __name__ == "__main__":
+    unittest.main()